@@ -0,0 +1,255 @@
+""" Benchmarks the command handlers offline
+
+Synthetic stand-ins for the covid19india.org CSVs, MOHFW JSON and HTML
+and the NDMA ArcGIS response, kept in fixtures/, are served by a local
+stub server, and replies go to a fake bot that records them instead of
+calling Telegram.
+
+Reports for each command the latency with cold caches (fetch, parse,
+render and send) and warm caches, the peak memory allocated by a cold
+run, and then the throughput of concurrent clients.
+
+Usage: python benchmarks/bench_commands.py [--record] [--repeat N]
+                                           [--clients N] [--duration S]
+--record saves the live responses as the fixtures before running """
+import argparse
+import concurrent.futures
+import functools
+import http.server
+import itertools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchDir))
+import covid19indiatracker_bot as bot
+
+_fixtureDir = os.path.join(benchDir, 'fixtures')
+# Fixture and the link of the bot it stands in for
+_fixtures = {'state_wise.csv': 'siteNationalLink',
+             'district_wise.csv': 'siteDistrictLink',
+             'datanew.json': 'MOHFWAPILink',
+             'mohfw.html': 'MOHFWLink',
+             'ndma.json': 'NDMALink'}
+_requestChatId = -1001263158724  # Only chat /request is accepted from
+# Name, handler, message text and arguments of each benchmarked command
+_commands = [('covid19india', bot.covid19india, '/covid19india', []),
+             ('covid19india MH', bot.covid19india, '/covid19india MH',
+              ['MH']),
+             ('mohfwapi', bot.mohfw, '/mohfw api', ['api']),
+             ('mohfwsite', bot.mohfw, '/mohfw site', ['site']),
+             ('comparemohfw', bot.comparemohfw, '/comparemohfw api',
+              ['api']),
+             ('ndmaapi', bot.ndma, '/ndma', []),
+             ('comparendma', bot.comparendma, '/comparendma', []),
+             ('recon', bot.recon, '/recon', []),
+             ('statecodes', bot.statecodes, '/statecodes', []),
+             ('request', bot.request, '#request oxygen in Pune', [])]
+_phases = ['fetch', 'parse', 'render', 'send']
+
+
+class _FakeBot:
+    """ Records the calls the bot makes to Telegram """
+
+    def __init__(self):
+        self.sent = 0
+        self.condition = threading.Condition()
+
+    def _record(self, **kwargs):
+        with self.condition:
+            self.sent = self.sent + 1
+            self.condition.notify_all()
+
+    def send_message(self, **kwargs):
+        self._record(**kwargs)
+
+    def forward_message(self, **kwargs):
+        self._record(**kwargs)
+
+    def get_chat_member(self, chat_id, user_id):
+        return {'status': 'member'}
+
+    def waitFor(self, count):
+        """ Waits until count calls have been made """
+        with self.condition:
+            self.condition.wait_for(lambda: self.sent >= count)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """ Serves the fixtures without logging each request """
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _startStub():
+    """ Serves the fixtures and points the bot at them """
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        functools.partial(_QuietHandler, directory=_fixtureDir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for fixture, link in _fixtures.items():
+        setattr(bot, link, 'http://127.0.0.1:' + str(server.server_port) +
+                '/' + fixture)
+
+
+def _record():
+    """ Saves the live responses as the fixtures """
+    for fixture, link in _fixtures.items():
+        content, _ = bot._fetchURL(getattr(bot, link))
+        with open(os.path.join(_fixtureDir, fixture), 'wb') as f:
+            f.write(content)
+
+
+def _clearCaches():
+    """ Forgets every snapshot and message so the next command fetches """
+    bot._snapshots.clear()
+    bot._messageCache.clear()
+    bot._districtIndex.clear()
+
+
+def _clearMetrics():
+    """ Resets the metrics recorded by the bot """
+    with bot._metricsLock:
+        bot._histograms.clear()
+        bot._counters.clear()
+
+
+def _getMean(phase):
+    """ Returns the mean ms recorded for phase across labels """
+    with bot._metricsLock:
+        histograms = [value for key, value in bot._histograms.items()
+                      if key[0] == phase + '_seconds']
+    count = sum(histogram[1] for histogram in histograms)
+    if count == 0:
+        return 0
+    return sum(histogram[2] for histogram in histograms) / count * 1000
+
+
+_updateIds = itertools.count(1)
+
+
+def _run(fakeBot, handler, text, args, chatId=None):
+    """ Runs a handler like the dispatcher would and waits for its reply """
+    updateId = next(_updateIds)
+    if chatId is None:
+        # A chat of its own keeps the per chat send limit out of the way
+        chatId = updateId
+    chat = types.SimpleNamespace(id=chatId, type='group')
+    user = types.SimpleNamespace(id=1)
+    message = types.SimpleNamespace(
+        text=text, chat=chat, from_user=user, message_id=updateId,
+        reply_to_message=types.SimpleNamespace(text=None, message_id=None))
+    update = types.SimpleNamespace(update_id=updateId, effective_chat=chat,
+                                   message=message)
+    context = types.SimpleNamespace(bot=fakeBot, args=args)
+    with fakeBot.condition:
+        expected = fakeBot.sent + 1
+    bot._instrumented(handler)(update, context)
+    fakeBot.waitFor(expected)
+
+
+def _runCommand(fakeBot, command):
+    """ Runs one of the benchmarked commands """
+    name, handler, text, args = command
+    chatId = _requestChatId if name == 'request' else None
+    _run(fakeBot, handler, text, args, chatId)
+
+
+def _measureCommand(fakeBot, command, repeat):
+    """ Returns ms of a cold and a warm run, ms per phase of a cold run and
+    peak bytes allocated by a cold run """
+    cold = []
+    warm = []
+    _clearMetrics()
+    for i in range(repeat):
+        _clearCaches()
+        start = time.perf_counter()
+        _runCommand(fakeBot, command)
+        cold.append(time.perf_counter() - start)
+    phases = [_getMean(phase) for phase in _phases]
+    for i in range(repeat):
+        start = time.perf_counter()
+        _runCommand(fakeBot, command)
+        warm.append(time.perf_counter() - start)
+
+    _clearCaches()
+    tracemalloc.start()
+    _runCommand(fakeBot, command)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(cold) * 1000, min(warm) * 1000, phases, peak
+
+
+def _measureThroughput(fakeBot, clients, duration):
+    """ Returns commands completed per second by concurrent clients """
+    deadline = time.monotonic() + duration
+    counts = [0] * clients
+
+    def client(i):
+        commands = itertools.cycle(_commands[i % len(_commands):] +
+                                   _commands[:i % len(_commands)])
+        while time.monotonic() < deadline:
+            _runCommand(fakeBot, next(commands))
+            counts[i] = counts[i] + 1
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(clients) as executor:
+        list(executor.map(client, range(clients)))
+    return sum(counts) / (time.monotonic() - start)
+
+
+def _configureBot():
+    """ Keeps the bot off the disk and Telegram limits out of the way """
+    bot.snapshotDir = None
+    bot.historyFile = None
+    bot.subscriptionsFile = None
+    bot.sendGlobalRate = bot.sendChatRate = bot.sendChatBurst = 10**9
+    bot._initStateCodes(os.path.join(os.path.dirname(benchDir),
+                                     'statecodes.json'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--record', action='store_true')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    if args.record:
+        _record()
+    _configureBot()
+    _startStub()
+    fakeBot = _FakeBot()
+    # Warm up imports and connections
+    for command in _commands:
+        _runCommand(fakeBot, command)
+
+    print('COMMAND'.ljust(16) + 'COLD ms'.rjust(9) + 'WARM ms'.rjust(9) +
+          ''.join((phase.upper() + ' ms').rjust(11) for phase in _phases) +
+          'PEAK KiB'.rjust(10))
+    for command in _commands:
+        cold, warm, phases, peak = _measureCommand(fakeBot, command,
+                                                   args.repeat)
+        print(command[0].ljust(16) + '{0:9.2f}{1:9.2f}'.format(cold, warm) +
+              ''.join('{0:11.2f}'.format(phase) for phase in phases) +
+              '{0:10.1f}'.format(peak / 1024))
+
+    bot.snapshotTTL = 0  # Every command revalidates its sources
+    _clearCaches()
+    print('Throughput, ' + str(args.clients) + ' clients: ' +
+          '{0:.1f} commands/s with revalidation, '.format(
+              _measureThroughput(fakeBot, args.clients, args.duration)),
+          end='')
+    bot.snapshotTTL = 10**9
+    print('{0:.1f} commands/s from cache'.format(
+        _measureThroughput(fakeBot, args.clients, args.duration)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+""" Benchmarks scraping of the state table from MOHFW web site
+
+Compares the BeautifulSoup parse of the whole page that the bot used
+earlier with the streaming parser that stops after the state table.
+
+Usage: python benchmarks/bench_mohfwsite.py [--record] [--repeat N] [html]
+--record saves the live MOHFW home page as the fixture before running """
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchDir))
+import covid19indiatracker_bot as bot
+
+_fixtureFile = os.path.join(benchDir, 'fixtures', 'mohfw.html')
+
+
+def _parseWithBeautifulSoup(content):
+    """ Scrapes the state table the way the bot did before """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, 'html.parser')
+    divTag = soup.find('table', attrs={'class': 'table table-striped'})
+    rows = divTag.find_all('tr')
+    # Discard first row containing header
+    rows = rows[1:]
+
+    stateName = []
+    active = []
+    recovered = []
+    deaths = []
+    confirmed = []
+    for row in rows:
+        cols = row.find_all('td')
+        if len(cols) == 6:
+            stateName.append(cols[1].text)
+            active.append(cols[2].text)
+            recovered.append(cols[3].text)
+            deaths.append(cols[4].text)
+            confirmed.append(cols[5].text)
+
+    data = bot._newStatewise([bot._getStateKey(state) for state in stateName],
+                             active, recovered, deaths, confirmed)
+    data.loc[data['State_code'] == 'UN', ['Recovered', 'Deaths']] = bot.pd.NA
+    return data
+
+
+def _measure(parse, content, repeat):
+    """ Returns best seconds per parse and peak bytes allocated by one """
+    seconds = min(timeit.repeat(lambda: parse(content), number=1,
+                                repeat=repeat))
+    tracemalloc.start()
+    parse(content)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('html', nargs='?', default=_fixtureFile)
+    parser.add_argument('--record', action='store_true')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.record:
+        content, _ = bot._fetchURL(bot.MOHFWLink)
+        with open(args.html, 'wb') as f:
+            f.write(content)
+    with open(args.html, 'rb') as f:
+        content = f.read()
+
+    bot._initStateCodes(os.path.join(os.path.dirname(benchDir),
+                                     'statecodes.json'))
+    baseline = _parseWithBeautifulSoup(content)
+    streamed = bot._parseMOHFWSiteData(content)
+    if not baseline.reset_index(drop=True).equals(
+            streamed.reset_index(drop=True)):
+        raise SystemExit('Parsers disagree on ' + args.html)
+
+    print('Page: ' + args.html + ' (' + str(len(content)) + ' bytes, ' +
+          str(len(streamed)) + ' states)')
+    print('PARSER'.ljust(14) + 'TIME (ms)'.rjust(12) + 'PEAK (KiB)'.rjust(12))
+    results = {}
+    for name, parse in [('beautifulsoup', _parseWithBeautifulSoup),
+                        ('streaming', bot._parseMOHFWSiteData)]:
+        seconds, peak = _measure(parse, content, args.repeat)
+        results[name] = (seconds, peak)
+        print(name.ljust(14) + '{0:12.2f}{1:12.1f}'.format(seconds * 1000,
+                                                          peak / 1024))
+    print('Speedup: {0:.1f}x, memory: {1:.1f}x less'.format(
+        results['beautifulsoup'][0] / results['streaming'][0],
+        results['beautifulsoup'][1] / results['streaming'][1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+""" Benchmarks the memory taken by the snapshots of each source
+
+Compares the whole untyped csv that the bot kept earlier with the typed
+columns it keeps now, and reports the size of the parsed snapshots of the
+other sources.
+
+Usage: python benchmarks/bench_snapshot_memory.py [--repeat N] """
+import argparse
+import io
+import os
+import sys
+import timeit
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchDir))
+import covid19indiatracker_bot as bot
+
+_fixtureDir = os.path.join(benchDir, 'fixtures')
+# Source, fixture, parser used earlier or None and parser used now
+_sources = [('national', 'state_wise.csv',
+             lambda content: bot.pd.read_csv(io.BytesIO(content)),
+             bot._parseNationalData),
+            ('district', 'district_wise.csv',
+             lambda content: bot.pd.read_csv(io.BytesIO(content)),
+             bot._parseDistrictData),
+            ('mohfwapi', 'datanew.json', None, bot._parseMOHFWAPIData),
+            ('mohfwsite', 'mohfw.html', None, bot._parseMOHFWSiteData),
+            ('ndma', 'ndma.json', None, bot._parseNDMAData)]
+
+
+def _measure(parse, content, repeat):
+    """ Returns bytes taken by the parsed data and best ms per parse """
+    size = parse(content).memory_usage(index=True, deep=True).sum()
+    seconds = min(timeit.repeat(lambda: parse(content), number=1,
+                                repeat=repeat))
+    return size, seconds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    bot._initStateCodes(os.path.join(os.path.dirname(benchDir),
+                                     'statecodes.json'))
+    print('SOURCE'.ljust(10) + 'ROWS'.rjust(6) + 'BEFORE KiB'.rjust(12) +
+          'AFTER KiB'.rjust(12) + 'BEFORE ms'.rjust(11) +
+          'AFTER ms'.rjust(10))
+    for source, fixture, before, after in _sources:
+        with open(os.path.join(_fixtureDir, fixture), 'rb') as f:
+            content = f.read()
+        rows = len(after(content))
+        size, ms = _measure(after, content, args.repeat)
+        line = source.ljust(10) + str(rows).rjust(6)
+        if before is None:
+            line = line + '-'.rjust(12) + '{0:12.1f}'.format(size / 1024) + \
+                '-'.rjust(11) + '{0:10.2f}'.format(ms)
+        else:
+            sizeBefore, msBefore = _measure(before, content, args.repeat)
+            line = line + '{0:12.1f}{1:12.1f}{2:11.2f}{3:10.2f}'.format(
+                sizeBefore / 1024, size / 1024, msBefore, ms)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+""" Benchmarks the start up of the bot
+
+Each run starts a new interpreter that imports the bot, replies to /help
+and then to /covid19india, fetching from the fixtures served by the stub
+of bench_commands.py. Reports the median time from the start of the
+import to each of those points, with the bot as it is and with pandas and
+requests imported up front as the bot did before they were left to first
+use.
+
+Usage: python benchmarks/bench_startup.py [--runs N] """
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def _child(eager):
+    """ Measures one start up, prints the results as JSON """
+    start = time.perf_counter()
+    if eager:
+        import pandas
+        import requests
+    sys.path.insert(0, os.path.dirname(benchDir))
+    import covid19indiatracker_bot as bot
+    imported = time.perf_counter()
+    heavyLoaded = 'pandas' in sys.modules
+
+    import bench_commands
+    bench_commands._configureBot()
+    bench_commands._startStub()
+    fakeBot = bench_commands._FakeBot()
+    bench_commands._run(fakeBot, bot.help, '/help', [])
+    firstReply = time.perf_counter()
+    bench_commands._run(fakeBot, bot.covid19india, '/covid19india', [])
+    firstData = time.perf_counter()
+    print(json.dumps({'import': imported - start,
+                      'reply': firstReply - start,
+                      'data': firstData - start,
+                      'heavyLoaded': heavyLoaded}))
+
+
+def _measure(eager, runs):
+    """ Returns the median of each time over runs start ups """
+    results = []
+    for i in range(runs):
+        output = subprocess.run(
+            [sys.executable, __file__, '--child'] + (['--eager'] if eager
+                                                     else []),
+            check=True, stdout=subprocess.PIPE, cwd=benchDir).stdout
+        results.append(json.loads(output.decode().splitlines()[-1]))
+    return {key: statistics.median(result[key] for result in results)
+            for key in ['import', 'reply', 'data']}, results[0]['heavyLoaded']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--eager', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        _child(args.eager)
+        return
+
+    print('IMPORTS'.ljust(8) + 'IMPORT ms'.rjust(11) + '/help ms'.rjust(10) +
+          '/covid19india ms'.rjust(18) + '  PANDAS AT IMPORT')
+    for name, eager in [('eager', True), ('lazy', False)]:
+        times, heavyLoaded = _measure(eager, args.runs)
+        print(name.ljust(8) + '{0:11.1f}{1:10.1f}{2:18.1f}'.format(
+            times['import'] * 1000, times['reply'] * 1000,
+            times['data'] * 1000) + '  ' + ('yes' if heavyLoaded else 'no'))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,111 +2,1765 @@
 from sys import version_info
 # if version_info.major > 2:
 #     raise Exception('This code does not work with Python 3. Use Python 2')
-import requests
-import pandas as pd
 import json
-import operator
-from telegram import ParseMode
-from telegram.ext import Updater, CommandHandler
+import collections
+import datetime
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import copy
+import csv
+import cProfile
+import atexit
+import bisect
+import difflib
+import functools
+from telegram import (InlineQueryResultArticle, InputTextMessageContent,
+                      ParseMode)
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import Updater, CommandHandler, InlineQueryHandler
 from telegram.ext.messagehandler import MessageHandler
 from telegram.ext.filters import Filters
+import gzip
+import hashlib
+import http.server
+import importlib
+import importlib.util
+import io
+import mmap
+import multiprocessing
 import logging
-import urllib3
-from bs4 import BeautifulSoup
+import logging.handlers
+import os
+import pickle
+import pstats
+import queue
+import random
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import types
+from html.parser import HTMLParser
+
+
+class _LazyModule(types.ModuleType):
+    """ Stands for a module that is imported when it is first used """
+    """ pandas and requests take most of the start up time and are not
+    needed to start polling """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        with self._lock:
+            # Attributes are found without calling this once imported
+            if attribute not in self.__dict__:
+                module = importlib.import_module(self.__name__)
+                self.__dict__.update(module.__dict__)
+        return self.__dict__[attribute]
+
+
+pd = _LazyModule('pandas')
+requests = _LazyModule('requests')
 
 # Bot details
 _tokenFile = 'TOKEN'
-logging.basicConfig(filename='covid19indiatracker_bot.log',
-                    format='%(asctime)s - %(name)s - \
-                    %(levelname)s - %(message)s',
-                    level=logging.INFO)
 _allowRequests = True
 _allowRequestsReply = False
 
+# Logs, written by a background thread and rotated by size
+logFile = 'covid19indiatracker_bot.log'
+logMaxBytes = 10 * 1024 * 1024
+logBackupCount = 5
+logJSON = False  # Write JSON lines instead of text
+_logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+_logContext = threading.local()  # Id of the update handled by a thread
+_logListener = None
+
+# Update processing
+warmUpDelay = 1  # Seconds after polling starts to import pandas and requests
+updateWorkers = 16  # Threads that run command handlers
+asyncHandlers = True  # Keep slow handlers off the update-processing thread
+webhookURL = None  # Public URL Telegram posts updates to, use None to poll
+webhookListen = '127.0.0.1'  # Local server behind the public URL
+webhookPort = 8443
+
 webPageLink = 'https://www.covid19india.org'
 MOHFWAPILink = "https://www.mohfw.gov.in/data/datanew.json"
 MOHFWLink = 'https://www.mohfw.gov.in'
 NDMALink = 'https://utility.arcgis.com/usrsvcs/servers/83b36886c90942ab9f67e7a212e515c8/rest/services/Corona/DailyCasesMoHUA/MapServer/0/query?f=json&where=1%3D1&returnGeometry=true&spatialRel=esriSpatialRelIntersects&maxAllowableOffset=9783&geometry=%7B%22xmin%22%3A5009377.085690986%2C%22ymin%22%3A0.000004991888999938965%2C%22xmax%22%3A10018754.171386965%2C%22ymax%22%3A5009377.08570097%2C%22spatialReference%22%3A%7B%22wkid%22%3A102100%7D%7D&geometryType=esriGeometryEnvelope&inSR=102100&outFields=*&outSR=102100&cacheHint=false'
 _stateNameCodeDict = {}
+_stateNameByCode = {}
+_stateKeyIndex = {}
+_stateCodesMessage = ''
+# Names used by MOHFW and NDMA that differ from covid19india.org
+_stateAliases = {'Telengana': 'TG',
+                 'Dadar Nagar Haveli': 'DN',
+                 'Cases being reassigned to states': 'UN'}
+_countColumns = ['Active', 'Recovered', 'Deaths', 'Confirmed']
+# Columns kept from the covid19india.org CSVs and their types, None keeps
+# the parsed type
+_nationalColumns = {'State': None, 'State_code': None, 'Confirmed': 'int32',
+                    'Recovered': 'int32', 'Deaths': 'int32',
+                    'Active': 'int32'}
+_districtColumns = {'State_Code': 'category', 'District': None,
+                    'Confirmed': 'int32', 'Active': 'int32',
+                    'Recovered': 'int32', 'Deceased': 'int32'}
 unavblCode = 'UNAVBL'.ljust(6, ' ')
 zeroCode = ' 0'.ljust(6, ' ')
 mohfwDefaultSource = 'api'  # Use 'api' or 'site'
+siteNationalLink = 'https://api.covid19india.org/csv/latest/state_wise.csv'
+siteDistrictLink = 'https://api.covid19india.org/csv/latest/district_wise.csv'
+
+# Snapshot cache
+snapshotTTL = 600  # Seconds for which a fetched snapshot is reused
+snapshotRetryDelay = 15  # Seconds to wait before retrying a failed refresh
+_snapshots = {}
+_snapshotLocks = {}
+_snapshotLocksGuard = threading.Lock()
+
+# Snapshots stored on disk to start warm, use None to disable
+snapshotDir = 'snapshots'
+storedSnapshotGrace = 120  # Seconds a stale stored snapshot is served for
+_storedSnapshotsLoaded = set()
+
+# Background prefetch (seconds), use None to disable a source
+prefetchIntervals = {'national': 60, 'district': 120, 'mohfwapi': 120,
+                     'mohfwsite': 300, 'ndma': 300}
+prefetchJitter = 0.1  # Fraction of the interval added or removed at random
+prefetchMaxBackoff = 1800
+fetchDeadline = 20  # Seconds a command waits for all of its sources
+_fetchExecutor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix='fetch')
+_pendingFetches = {}  # key -> future of the refresh shared by all callers
+
+# Upstream connections
+httpTimeout = (5, 30)  # Seconds to connect and to wait for data
+httpPoolConnections = 4  # Number of hosts to keep connections to
+httpPoolSize = 8  # Connections kept alive per host
+_httpSession = None
+_httpSessionLock = threading.Lock()
+
+# History of counts, recorded only when they change
+historyFile = 'history.csv'  # Use None to keep history in memory only
+historyMaxDays = 60
+_historyColumns = ['Date', 'State_code', 'District'] + _countColumns
+_history = None  # (State_code, District) -> [(date, counts)] by date
+_historyPrunedDate = None
+_historyLock = threading.Lock()
+
+# Outbound Telegram calls, sent by a few threads within Telegram's limits
+sendPriorityReply = 0  # Replies to commands are sent first
+sendPriorityBroadcast = 1
+sendGlobalRate = 30  # Messages per second across all chats
+sendChatRate = 1  # Messages per second to one chat
+sendChatBurst = 3
+sendMaxAttempts = 3
+sendThreads = 8  # Calls to Telegram in flight at once
+_sendQueue = []
+_sendCount = 0
+_sendCondition = threading.Condition()
+_sendGlobalBucket = None
+_sendChatBuckets = {}
+_sendPausedUntil = 0  # Set when more than one chat is throttled at once
+_sendChatPauses = {}  # Chat id -> time its throttling ends
+_sendBusyChats = set()  # Chats with a call in flight, sent in order
+_sendThreads = []
+
+# Alerts pushed to subscribed chats when snapshots change
+subscriptionsFile = 'subscriptions.json'
+alertThreshold = 100  # Cases a count has to change by to be alerted
+_subscriptions = {}  # Topic ('mohfw', 'ndma' or state code) -> chat ids
+_subscriptionsLock = threading.Lock()
+_alertedDrift = {}  # Topic -> differences last alerted per state
+alertedDriftFile = 'alerted_drift.json'  # Use None to alert again on restart
+_alertBot = None
+_alertExecutor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='alert')
+
+# Chart images, drawn with matplotlib when it is installed
+chartFileIdsFile = 'chart_file_ids.json'
+chartFileIdsSize = 1000
+_chartFileIds = collections.OrderedDict()  # Chart digest -> Telegram file_id
+_chartFileIdsLock = threading.Lock()
+# Redraws charts whose file_id Telegram rejected, off the sender threads
+_chartExecutor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix='chart')
+
+# Inline query answers, rebuilt whenever the data they show changes
+inlineCacheTime = 60  # Seconds Telegram may reuse an answer
+_inlineIndex = []  # Sorted (normalized state key or keyword, result key)
+_inlineKeywords = {'INDIA': 'national', 'NATIONAL': 'national',
+                   'MOHFW': 'comparemohfw', 'COMPARE': 'comparemohfw'}
+_inlineResults = {}  # Result key -> InlineQueryResultArticle
+_inlineExecutor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='inline')
+
+# Status of users in chats, used for admin checks
+adminCacheTTL = 300
+_chatMemberCache = {}  # (chat id, user id) -> (status, expiry time)
+_chatMemberCacheLock = threading.Lock()
+
+# Districts of the last district snapshot grouped by state
+_districtIndex = {}
+_districtIndexLock = threading.Lock()
+
+# Rendered messages, evicted least recently used first
+messageCacheSize = 128
+_messageCache = collections.OrderedDict()
+_messageCacheLock = threading.Lock()
+# Messages being built, shared by identical commands that arrive meanwhile
+_pendingMessages = {}  # name -> future of the message
+
+# Processes that render messages from snapshots mapped read-only, the bot
+# process keeps fetching and publishes every snapshot version they need
+renderProcesses = 0  # Use 0 to render in the bot process
+_renderExecutor = None
+_renderExecutorLock = threading.Lock()
+_renderStateCodesFile = None
+_sharedSnapshotDir = None
+_sharedSnapshotHeader = struct.Struct('<4sQQI')  # Magic, version, size, count
+_publishedVersions = {}  # key -> version written to the shared directory
+_publishLock = threading.Lock()
+_mappedSnapshots = {}  # key -> (version, data), in render processes
+
+# Metrics, served on http://metricsListen:metricsPort/metrics
+metricsListen = '127.0.0.1'
+metricsPort = 9464  # Use None to disable the endpoint
+statsAdminIds = set()  # Telegram user ids allowed to use /stats
+_histogramBuckets = {
+    'seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    'bytes': (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)}
+_histograms = {}  # (name, label) -> [count per bucket, count, sum]
+_counters = collections.Counter()  # (name, label) -> count
+_metricsLock = threading.Lock()
+# Profile a fraction of commands and log those slower than the threshold
+profileSampleRate = 0  # Use 0 to disable profiling
+profileSlowThreshold = 2  # Seconds
+profileLines = 25
+
+
+def _observe(name, label, value):
+    """ Adds a value to a histogram, name ends with the unit of value """
+    buckets = _histogramBuckets[name.rsplit('_', 1)[1]]
+    with _metricsLock:
+        histogram = _histograms.get((name, label))
+        if histogram is None:
+            histogram = [[0] * len(buckets), 0, 0]
+            _histograms[(name, label)] = histogram
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][i] = histogram[0][i] + 1
+        histogram[1] = histogram[1] + 1
+        histogram[2] = histogram[2] + value
+
+
+def _count(name, label, value=1):
+    """ Adds to a counter """
+    with _metricsLock:
+        _counters[(name, label)] += value
+
+
+@contextlib.contextmanager
+def _measure(phase, label):
+    """ Records the time spent in the block as a latency of phase """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe(phase + '_seconds', label, time.perf_counter() - start)
+
+
+def _getMetricsText():
+    """ Returns the metrics in the Prometheus text format """
+    with _metricsLock:
+        histograms = {key: (list(value[0]), value[1], value[2])
+                      for key, value in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for (name, label), (counts, count, total) in sorted(histograms.items()):
+        metric = 'covid19india_bot_' + name
+        buckets = _histogramBuckets[name.rsplit('_', 1)[1]]
+        for bound, bucketCount in zip(buckets, counts):
+            lines.append(metric + '_bucket{label="' + label + '",le="' +
+                         str(bound) + '"} ' + str(bucketCount))
+        lines.append(metric + '_bucket{label="' + label + '",le="+Inf"} ' +
+                     str(count))
+        lines.append(metric + '_count{label="' + label + '"} ' + str(count))
+        lines.append(metric + '_sum{label="' + label + '"} ' + str(total))
+    for (name, label), count in sorted(counters.items()):
+        lines.append('covid19india_bot_' + name + '_total{label="' + label +
+                     '"} ' + str(count))
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves the metrics to local scrapers """
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = _getMetricsText().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _startMetricsServer():
+    """ Serves the metrics endpoint from a background thread """
+    if metricsPort is None:
+        return
+    try:
+        server = http.server.ThreadingHTTPServer(
+            (metricsListen, metricsPort), _MetricsRequestHandler)
+    except OSError:
+        logging.info('Metrics server: FAILED')
+        return
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+
+
+def _instrumented(callback):
+    """ Records the latency of a handler, profiling a sample of its calls """
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    def run(update, context):
+        _logContext.requestId = update.update_id
+        profile = None
+        if profileSampleRate and random.random() < profileSampleRate:
+            profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            if profile is None:
+                return callback(update, context)
+            return profile.runcall(callback, update, context)
+        finally:
+            seconds = time.perf_counter() - start
+            _observe('command_seconds', name, seconds)
+            logging.info('Command completed: ' + name + ' in ' +
+                         '{0:.3f}s'.format(seconds),
+                         extra={'seconds': round(seconds, 4)})
+            if profile is not None and seconds > profileSlowThreshold:
+                stream = io.StringIO()
+                pstats.Stats(profile, stream=stream) \
+                    .sort_stats('cumulative').print_stats(profileLines)
+                logging.info('Slow command ' + name + ' took ' +
+                             '{0:.2f}s\n'.format(seconds) + stream.getvalue())
+            _logContext.requestId = None
+    return run
+
+
+class _LogContextFilter(logging.Filter):
+    """ Tags records with the update being handled by the logging thread """
+
+    def filter(self, record):
+        record.requestId = getattr(_logContext, 'requestId', None)
+        return True
 
 
-def _getSiteData(statewise=False):
-    """ Retrieves data from api link """
-    if statewise == False:
-        link = 'https://api.covid19india.org/csv/latest/state_wise.csv'
+class _JSONFormatter(logging.Formatter):
+    """ Formats records as JSON lines """
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'name': record.name,
+                 'level': record.levelname, 'message': record.getMessage(),
+                 'requestId': getattr(record, 'requestId', None)}
+        if hasattr(record, 'seconds'):
+            entry['seconds'] = record.seconds
+        if getattr(record, 'exception', None):
+            entry['exception'] = record.exception
+        return json.dumps(entry)
+
+
+class _JSONQueueHandler(logging.handlers.QueueHandler):
+    """ Queues records with their traceback in an exception field """
+    """ QueueHandler would append it to the message and drop exc_info """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.exception = None
+        if record.exc_info:
+            record.exception = _JSONFormatter().formatException(
+                record.exc_info)
+        record.exc_info = None
+        record.exc_text = None
+        return super().prepare(record)
+
+
+def _startLogging():
+    """ Sends log records through a queue to a thread that writes them """
+    """ Handlers only pay for putting the record in the queue, the file is
+    written and rotated by the listener thread """
+    global _logListener
+    fileHandler = logging.handlers.RotatingFileHandler(
+        logFile, maxBytes=logMaxBytes, backupCount=logBackupCount)
+    if logJSON:
+        fileHandler.setFormatter(_JSONFormatter())
+    else:
+        fileHandler.setFormatter(logging.Formatter(_logFormat))
+    logQueue = queue.SimpleQueue()
+    if logJSON:
+        queueHandler = _JSONQueueHandler(logQueue)
     else:
-        link = 'https://api.covid19india.org/csv/latest/district_wise.csv'
+        queueHandler = logging.handlers.QueueHandler(logQueue)
+    queueHandler.addFilter(_LogContextFilter())
+    root = logging.getLogger()
+    root.addHandler(queueHandler)
+    root.setLevel(logging.INFO)
+    _logListener = logging.handlers.QueueListener(logQueue, fileHandler)
+    _logListener.start()
+
+
+def _stopLogging():
+    """ Writes the records still in the queue """
+    if _logListener is not None:
+        _logListener.stop()
+
+
+def _getSnapshotLock(key):
+    """ Returns the lock that serializes refreshes of a snapshot """
+    with _snapshotLocksGuard:
+        if key not in _snapshotLocks:
+            _snapshotLocks[key] = threading.Lock()
+        return _snapshotLocks[key]
+
+
+def _refreshSnapshot(key, ttl=None):
+    """ Fetches a new snapshot for key, returns False if the fetch failed """
+    """ Callers must hold the lock of the snapshot """
+    if ttl is None:
+        ttl = snapshotTTL
+    _loadStoredSnapshot(key, ttl)
+    snapshot = _snapshots.get(key)
+    getLink, parse = _snapshotSources[key]
+    validators = None if snapshot is None else snapshot['validators']
     try:
-        data = pd.read_csv(link)
+        with _measure('fetch', key):
+            content, validators = _fetchURL(getLink(), validators)
+        if content is None:
+            logging.info('Stats retrieval: NOT MODIFIED')
+            _count('fetches_not_modified', key)
+            snapshot['time'] = time.time()
+            snapshot['expires'] = snapshot['time'] + ttl
+            if not _inlineResults:
+                _scheduleInlineResults(key)
+            return True
+        _observe('payload_bytes', key, len(content))
+        with _measure('parse', key):
+            data = parse(content)
         logging.info('Stats retrieval: SUCCESS')
-        return data
-    except:
+    except Exception:
         logging.info('Stats retrieval: FAILED')
-        return None
+        _count('fetch_failures', key)
+        if snapshot is not None:
+            snapshot['expires'] = time.time() + snapshotRetryDelay
+        return False
+
+    now = time.time()
+    version = 1 if snapshot is None else snapshot['version'] + 1
+    _snapshots[key] = {'data': data, 'time': now, 'expires': now + ttl,
+                       'version': version, 'validators': validators}
+    _storeSnapshot(key, content, now, validators)
+    _onSnapshotChanged(key, None if snapshot is None else snapshot['data'],
+                       data)
+    return True
 
 
-def _getMOHFWData(site=False):
-    """ Retrieves data from MOHFW API or site"""
-    logging.info('Command invoked: _getMOHFWData')
-    if site == False:
-        # Retrieve data from API
+def _getStoredSnapshotFile(key):
+    """ Returns the file a snapshot is stored in """
+    return os.path.join(snapshotDir, key + '.gz')
+
+
+def _storeSnapshot(key, content, fetchTime, validators):
+    """ Writes the fetched content of a snapshot to disk """
+    """ The file is replaced atomically so a crash never leaves a partial
+    snapshot behind """
+    if snapshotDir is None:
+        return
+    header = json.dumps({'time': fetchTime, 'validators': validators})
+    try:
+        os.makedirs(snapshotDir, exist_ok=True)
+        fd, tempFile = tempfile.mkstemp(dir=snapshotDir, prefix=key + '.')
         try:
-            data = requests.get(MOHFWAPILink).json()
-            logging.info('Stats retrieval: SUCCESS')
-            return data
-        except:
-            logging.info('Stats retrieval: FAILED')
-            return None
+            with os.fdopen(fd, 'wb') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as gzipFile:
+                    gzipFile.write(header.encode() + b'\n' + content)
+            os.replace(tempFile, _getStoredSnapshotFile(key))
+        except BaseException:
+            os.remove(tempFile)
+            raise
+    except OSError:
+        logging.info('Snapshot store: FAILED ' + key)
+
+
+def _loadStoredSnapshot(key, ttl=None):
+    """ Loads a snapshot stored on disk if key was not fetched yet """
+    """ Callers must hold the lock of the snapshot """
+    if ttl is None:
+        ttl = snapshotTTL
+    if snapshotDir is None or key in _storedSnapshotsLoaded:
+        return
+    _storedSnapshotsLoaded.add(key)
+    if key in _snapshots:
+        return
+    try:
+        with gzip.open(_getStoredSnapshotFile(key), 'rb') as f:
+            header, content = f.read().split(b'\n', 1)
+        header = json.loads(header)
+        data = _snapshotSources[key][1](content)
+    except FileNotFoundError:
+        return
+    except Exception:
+        logging.info('Snapshot load: FAILED ' + key)
+        return
+
+    # Serve a stale snapshot until the prefetch has had time to refresh it
+    expires = max(header['time'] + ttl, time.time() + storedSnapshotGrace)
+    _snapshots[key] = {'data': data, 'time': header['time'],
+                       'expires': expires, 'version': 1,
+                       'validators': header['validators']}
+    logging.info('Snapshot load: SUCCESS ' + key)
+    # A warm start may only ever see 304s, so answer inline queries now
+    _scheduleInlineResults(key)
+
+
+def _isSnapshotFresh(key):
+    """ Checks if a snapshot can be served without fetching it again """
+    snapshot = _snapshots.get(key)
+    return snapshot is not None and time.time() < snapshot['expires']
+
+
+def _getSnapshotEntry(key, ttl=None):
+    """ Returns the cache entry of key, fetching it again once it has expired """
+    """ Concurrent callers wait on a single fetch and the last good
+    snapshot is served when a refresh fails """
+    if _isSnapshotFresh(key):
+        return _snapshots[key]
+
+    with _getSnapshotLock(key):
+        _loadStoredSnapshot(key, ttl)
+        # Another thread may have refreshed it while we were waiting
+        if _isSnapshotFresh(key):
+            return _snapshots[key]
+        if not _refreshSnapshot(key, ttl) and key in _snapshots:
+            logging.info('Serving stale snapshot: ' + key)
+        return _snapshots.get(key)
+
+
+def _getSnapshot(key, ttl=None):
+    """ Returns cached data for key, None if it could never be fetched """
+    snapshot = _getSnapshotEntry(key, ttl)
+    return None if snapshot is None else snapshot['data']
+
+
+def _getSnapshots(sources, deadline=None):
+    """ Returns {source: cache entry}, fetching expired sources in parallel """
+    """ Sources that could not be fetched before the deadline get their stale
+    entry, or None if they were never fetched """
+    if deadline is None:
+        deadline = fetchDeadline
+    snapshots = {}
+    futures = {}
+    for source in sources:
+        if _isSnapshotFresh(source):
+            _count('snapshot_hits', source)
+            snapshots[source] = _snapshots[source]
+        else:
+            _count('snapshot_misses', source)
+            futures[source] = _getPendingFetch(source)
+
+    if futures:
+        concurrent.futures.wait(futures.values(), timeout=deadline)
+        for source, future in futures.items():
+            if future.done():
+                snapshots[source] = future.result()
+            else:
+                logging.info('Fetch deadline exceeded: ' + source)
+                snapshots[source] = _snapshots.get(source)
+    return snapshots
+
+
+def _getPendingFetch(key):
+    """ Returns the future of the refresh of key, submitting one if none is
+    in flight """
+    """ A stalled source then holds a single fetch worker instead of one
+    per command waiting for it """
+    with _snapshotLocksGuard:
+        future = _pendingFetches.get(key)
+        if future is not None:
+            return future
+        future = _fetchExecutor.submit(_getSnapshotEntry, key)
+        _pendingFetches[key] = future
+    # Called right away if it is already done, so not under the guard
+    future.add_done_callback(lambda done: _forgetPendingFetch(key, done))
+    return future
+
+
+def _forgetPendingFetch(key, future):
+    """ Lets the next miss of key submit a new refresh """
+    with _snapshotLocksGuard:
+        if _pendingFetches.get(key) is future:
+            del _pendingFetches[key]
+
+
+def _prefetchSnapshot(jobQueue, key, failures):
+    """ Refreshes a snapshot in the background and schedules the next run """
+    with _getSnapshotLock(key):
+        success = _refreshSnapshot(key)
+    if success:
+        failures = 0
+        delay = prefetchIntervals[key]
+    else:
+        failures = failures + 1
+        delay = min(prefetchIntervals[key] * 2**min(failures, 10),
+                    prefetchMaxBackoff)
+        logging.info('Prefetch of ' + key + ' failed, retrying in ' +
+                     str(int(delay)) + 's')
+    delay = delay * random.uniform(1 - prefetchJitter, 1 + prefetchJitter)
+    jobQueue.run_once(_prefetch, delay, context=(key, failures))
+
+
+def _prefetch(context):
+    """ Job callback that hands a prefetch to its own thread """
+    """ Jobs run on the job queue thread, so a slow upstream would
+    otherwise delay the refresh of every other source """
+    key, failures = context.job.context
+    threading.Thread(target=_prefetchSnapshot,
+                     args=(context.job_queue, key, failures),
+                     daemon=True).start()
+
+
+def _startPrefetch(jobQueue):
+    """ Schedules the first background refresh of every source """
+    for i, key in enumerate(prefetchIntervals):
+        if prefetchIntervals[key] is not None:
+            jobQueue.run_once(_prefetch, i, context=(key, 0))
+
+
+def _getHTTPSession():
+    """ Returns the shared session that pools keep-alive connections """
+    global _httpSession
+    with _httpSessionLock:
+        if _httpSession is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=httpPoolConnections,
+                pool_maxsize=httpPoolSize)
+            _httpSession = requests.Session()
+            _httpSession.mount('https://', adapter)
+            _httpSession.mount('http://', adapter)
+        return _httpSession
+
+
+def _fetchURL(link, validators=None):
+    """ Downloads link, returns its content and the validators for the
+    next conditional request. Content is None if it was not modified """
+    headers = {}
+    if validators:
+        if validators.get('ETag'):
+            headers['If-None-Match'] = validators['ETag']
+        if validators.get('Last-Modified'):
+            headers['If-Modified-Since'] = validators['Last-Modified']
+    response = _getHTTPSession().get(link, headers=headers,
+                                     timeout=httpTimeout)
+    if response.status_code == 304:
+        return None, validators
+    response.raise_for_status()
+    validators = {'ETag': response.headers.get('ETag'),
+                  'Last-Modified': response.headers.get('Last-Modified')}
+    return response.content, validators
+
+
+def _parseSiteData(content, columns):
+    """ Parses a csv from the api link """
+    """ Only columns are kept, with counts as 32 bit integers and repeated
+    names as categories, so a snapshot takes a fraction of the memory of
+    the whole csv """
+    data = pd.read_csv(io.BytesIO(content), usecols=list(columns))
+    for column, dtype in columns.items():
+        if dtype == 'int32' and data[column].dtype.kind != 'i':
+            # Blank counts make the column float
+            dtype = 'Int32'
+        if dtype is not None:
+            data[column] = data[column].astype(dtype)
+    return data
+
+
+def _parseNationalData(content):
+    """ Parses the statewise csv """
+    return _parseSiteData(content, _nationalColumns)
+
+
+def _parseDistrictData(content):
+    """ Parses the districtwise csv """
+    return _parseSiteData(content, _districtColumns)
+
+
+class _StateCounts:
+    """ Counts of one state, a light view of a row of statewise data """
+    __slots__ = ('stateCode', 'active', 'recovered', 'deaths', 'confirmed')
+
+    def __init__(self, stateCode, active, recovered, deaths, confirmed):
+        self.stateCode = stateCode
+        self.active = active
+        self.recovered = recovered
+        self.deaths = deaths
+        self.confirmed = confirmed
+
+
+def _getStateCounts(data):
+    """ Returns {state code: _StateCounts} of statewise data """
+    """ Missing counts are None """
+    columns = [[None if pd.isna(value) else int(value)
+                for value in data[column]] for column in _countColumns]
+    return {stateCode: _StateCounts(stateCode, *counts)
+            for stateCode, *counts in zip(data['State_code'], *columns)}
+
+
+def _newStatewise(stateCodes, active, recovered, deaths, confirmed):
+    """ Returns statewise counts of another source keyed by state code """
+    data = pd.DataFrame({'State_code': stateCodes, 'Active': active,
+                         'Recovered': recovered, 'Deaths': deaths,
+                         'Confirmed': confirmed})
+    for column in _countColumns:
+        values = [_removeSpecialChars(str(value)) for value in data[column]]
+        data[column] = pd.to_numeric(pd.Series(values, index=data.index),
+                                     errors='coerce').astype('Int32')
+    data = data.dropna(subset=['State_code'])
+    return data.drop_duplicates(subset='State_code')
+
+
+def _parseMOHFWAPIData(content):
+    """ Parses data from MOHFW API """
+    data = json.loads(content)
+    stateCodes = []
+    for stateDict in data:
+        if stateDict['sno'] == '11111':
+            stateCodes.append('TT')
+        else:
+            stateCodes.append(_getStateKey(str(stateDict['state_name'])))
+    return _newStatewise(stateCodes,
+                         [stateDict['new_active'] for stateDict in data],
+                         [stateDict['new_cured'] for stateDict in data],
+                         [stateDict['new_death'] for stateDict in data],
+                         [stateDict['new_positive'] for stateDict in data])
+
+
+class _MOHFWTableParser(HTMLParser):
+    """ Collects the cells of the state table on MOHFW web site """
+    """ Parsing stops as soon as the table has been read, so the rest of
+    the page is never tokenized """
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.rows = []
+        self.done = False
+        self._depth = 0  # Depth of tables from the state table onwards
+        self._row = None
+        self._cell = None
+
+    def _endCell(self):
+        if self._cell is not None:
+            self._row.append(''.join(self._cell))
+            self._cell = None
+
+    def _endRow(self):
+        self._endCell()
+        if self._row is not None:
+            self.rows.append(self._row)
+            self._row = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            tableClass = ' '.join((dict(attrs).get('class') or '').split())
+            if self._depth > 0 or tableClass == 'table table-striped':
+                self._depth = self._depth + 1
+        elif self._depth == 1:
+            if tag == 'tr':
+                self._endRow()
+                self._row = []
+            elif tag == 'td' and self._row is not None:
+                self._endCell()
+                self._cell = []
+
+    def handle_endtag(self, tag):
+        if self._depth == 0:
+            return
+        if tag == 'table':
+            self._depth = self._depth - 1
+            if self._depth == 0:
+                self._endRow()
+                self.done = True
+        elif self._depth == 1:
+            if tag == 'td':
+                self._endCell()
+            elif tag == 'tr':
+                self._endRow()
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+
+def _parseMOHFWSiteData(content, chunkSize=16384):
+    """ Scrapes the state table from MOHFW web site """
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+    parser = _MOHFWTableParser()
+    for start in range(0, len(content), chunkSize):
+        parser.feed(content[start:start+chunkSize])
+        if parser.done:
+            break
+    # Discard first row containing header
+    rows = [cols for cols in parser.rows[1:] if len(cols) == 6]
+    if not rows:
+        raise ValueError('State table not found on MOHFW web site')
+
+    data = _newStatewise([_getStateKey(cols[1]) for cols in rows],
+                         [cols[2] for cols in rows],
+                         [cols[3] for cols in rows],
+                         [cols[4] for cols in rows],
+                         [cols[5] for cols in rows])
+    # Cases being reassigned only report confirmed and active cases
+    data.loc[data['State_code'] == 'UN', ['Recovered', 'Deaths']] = pd.NA
+    return data
+
+
+def _parseNDMAData(content):
+    """ Parses data from NDMA API """
+    data = [feature['attributes']
+            for feature in json.loads(content)['features']]
+    data = _newStatewise([_getStateKey(str(stateDict['state_name']))
+                          for stateDict in data],
+                         [None] * len(data),
+                         [stateDict['cured_discharged_migrated']
+                          for stateDict in data],
+                         [stateDict['deaths'] for stateDict in data],
+                         [stateDict['confirmedcases'] for stateDict in data])
+    # NDMA does not report active cases
+    data['Active'] = data['Confirmed'] - data['Recovered'] - data['Deaths']
+    return data
+
+
+# Link and parser of each source
+_snapshotSources = {
+    'national': (lambda: siteNationalLink, _parseNationalData),
+    'district': (lambda: siteDistrictLink, _parseDistrictData),
+    'mohfwapi': (lambda: MOHFWAPILink, _parseMOHFWAPIData),
+    'mohfwsite': (lambda: MOHFWLink, _parseMOHFWSiteData),
+    'ndma': (lambda: NDMALink, _parseNDMAData),
+}
+
+
+def _getCachedMessage(name, sources, render):
+    """ Returns the message built by render() from the data of sources,
+    reusing an earlier message while those snapshots have not changed """
+    """ Callers asking for a message that is already being built wait for
+    it instead of fetching and rendering it again """
+    with _messageCacheLock:
+        pending = _pendingMessages.get(name)
+        if pending is None:
+            future = concurrent.futures.Future()
+            _pendingMessages[name] = future
+    if pending is not None:
+        _count('messages_coalesced', name[0])
+        return pending.result()
+
+    try:
+        message = _buildCachedMessage(name, sources, render)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(message)
+    finally:
+        with _messageCacheLock:
+            del _pendingMessages[name]
+    return message
+
+
+def _buildCachedMessage(name, sources, render):
+    """ Builds the message for _getCachedMessage """
+    snapshots = _getSnapshots(sources)
+    data = [None if snapshots[source] is None else snapshots[source]['data']
+            for source in sources]
+    if any(snapshots[source] is None for source in sources):
+        # Do not cache messages built without all of their data
+        return _renderMessage(name, render, data)
+
+    key = (name, tuple(snapshots[source]['version'] for source in sources))
+    with _messageCacheLock:
+        if key in _messageCache:
+            _messageCache.move_to_end(key)
+            _count('message_cache_hits', name[0])
+            return _messageCache[key]
+
+    _count('message_cache_misses', name[0])
+    if _renderExecutor is not None and name[0] in _sharedRenderers:
+        message = _renderInProcess(name, sources, snapshots, render, data)
+    else:
+        message = _renderMessage(name, render, data)
+    with _messageCacheLock:
+        _messageCache[key] = message
+        while len(_messageCache) > messageCacheSize:
+            _messageCache.popitem(last=False)
+    return message
+
+
+def _renderMessage(name, render, data):
+    """ Calls render() recording its latency and the size of the message """
+    with _measure('render', name[0]):
+        message = render(*data)
+    # Charts are rendered as PNG bytes
+    if isinstance(message, str):
+        _observe('message_bytes', name[0], len(message.encode()))
+    else:
+        _observe('message_bytes', name[0], len(message))
+    return message
+
+
+def _publishSnapshot(key, snapshot):
+    """ Writes a snapshot version to the shared directory once """
+    """ The pickled data is followed by the raw column buffers aligned to
+    64 bytes so that render processes can map them without copying """
+    with _publishLock:
+        if _publishedVersions.get(key) == snapshot['version']:
+            return
+        buffers = []
+        content = pickle.dumps(snapshot['data'], protocol=5,
+                               buffer_callback=buffers.append)
+        buffers = [buffer.raw() for buffer in buffers]
+        fd, tempFile = tempfile.mkstemp(dir=_sharedSnapshotDir,
+                                        prefix=key + '.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_sharedSnapshotHeader.pack(b'SNAP', snapshot['version'],
+                                               len(content), len(buffers)))
+            f.write(struct.pack('<' + 'Q' * len(buffers),
+                                *[buffer.nbytes for buffer in buffers]))
+            f.write(content)
+            for buffer in buffers:
+                f.write(b'\0' * (-f.tell() % 64))
+                f.write(buffer)
+        # Processes that mapped the previous version keep reading it
+        os.replace(tempFile, os.path.join(_sharedSnapshotDir, key + '.snap'))
+        _publishedVersions[key] = snapshot['version']
+
+
+def _mapSharedSnapshot(key, version):
+    """ Returns the data of a published snapshot, in a render process """
+    """ Column buffers stay in the read-only mapping of the file """
+    mapped = _mappedSnapshots.get(key)
+    if mapped is not None and mapped[0] >= version:
+        return mapped[1]
+    with open(os.path.join(_sharedSnapshotDir, key + '.snap'), 'rb') as f:
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    magic, version, size, count = _sharedSnapshotHeader.unpack_from(view)
+    offset = _sharedSnapshotHeader.size
+    sizes = struct.unpack_from('<' + 'Q' * count, view, offset)
+    offset = offset + 8 * count
+    content = view[offset:offset + size]
+    offset = offset + size
+    buffers = []
+    for bufferSize in sizes:
+        offset = offset + (-offset % 64)
+        buffers.append(view[offset:offset + bufferSize])
+        offset = offset + bufferSize
+    data = pickle.loads(content, buffers=buffers)
+    _mappedSnapshots[key] = (version, data)
+    return data
+
+
+def _initRenderProcess(stateCodesFile, sharedSnapshotDir):
+    """ Prepares a render process """
+    global _sharedSnapshotDir
+    _sharedSnapshotDir = sharedSnapshotDir
+    _initStateCodes(stateCodesFile)
+
+
+def _renderSharedMessage(name, versions):
+    """ Renders a message from published snapshots, in a render process """
+    data = [_mapSharedSnapshot(key, version) for key, version in versions]
+    return _sharedRenderers[name[0]](*data, *name[1:])
+
+
+def _renderInProcess(name, sources, snapshots, render, data):
+    """ Renders a message in a render process, publishing its snapshots """
+    """ If a render process died or did not answer within fetchDeadline the
+    message is rendered in the bot process and the render processes are
+    started again """
+    versions = []
+    for source in sources:
+        _publishSnapshot(source, snapshots[source])
+        versions.append((source, snapshots[source]['version']))
+    executor = _renderExecutor
+    try:
+        with _measure('render', name[0]):
+            message = executor.submit(_renderSharedMessage, name,
+                                      versions).result(fetchDeadline)
+    except (concurrent.futures.process.BrokenProcessPool,
+            concurrent.futures.TimeoutError):
+        logging.info('Render processes: FAILED')
+        _count('render_process_failures', name[0])
+        _restartRenderProcesses(executor)
+        return _renderMessage(name, render, data)
+    _observe('message_bytes', name[0], len(message.encode()))
+    return message
+
+
+def _restartRenderProcesses(executor):
+    """ Replaces a broken or hung pool of render processes once, however
+    many renders found it so """
+    global _renderExecutor
+    with _renderExecutorLock:
+        if _renderExecutor is not executor:
+            return
+        _renderExecutor = _newRenderExecutor()
+    # A hung process would never pick up the shutdown, so stop it
+    processes = getattr(executor, '_processes', None) or {}
+    for process in list(processes.values()):
+        process.kill()
+    executor.shutdown(wait=False)
+
+
+def _startRenderProcesses(stateCodesFile):
+    """ Starts the render processes if renderProcesses is set """
+    global _renderExecutor
+    global _renderStateCodesFile
+    global _sharedSnapshotDir
+    if not renderProcesses:
+        return
+    _renderStateCodesFile = stateCodesFile
+    # Memory backed where available so snapshots never touch the disk
+    sharedRoot = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    _sharedSnapshotDir = tempfile.mkdtemp(prefix='covid19india_bot.',
+                                          dir=sharedRoot)
+    atexit.register(shutil.rmtree, _sharedSnapshotDir, True)
+    _renderExecutor = _newRenderExecutor()
+
+
+def _newRenderExecutor():
+    """ Returns a pool of render processes mapping the shared directory """
+    # Forking would copy the locks held by the threads of the bot process
+    return concurrent.futures.ProcessPoolExecutor(
+        renderProcesses, mp_context=multiprocessing.get_context('spawn'),
+        initializer=_initRenderProcess,
+        initargs=(_renderStateCodesFile, _sharedSnapshotDir))
+
+
+def _loadHistory():
+    """ Loads the history recorded on disk on first use """
+    """ Callers must hold the history lock. Rows that do not parse, like a
+    line cut short by a crash while appending, are dropped from the file """
+    global _history
+    if _history is not None:
+        return
+    _history = {}
+    if historyFile is None or not os.path.exists(historyFile):
+        return
+    try:
+        with open(historyFile, 'r', newline='') as f:
+            lines = f.read().split('\n')
+    except OSError:
+        logging.info('History load: FAILED')
+        return
+    # The last line is only complete if the file ends with a newline
+    skipped = 0 if lines[-1] == '' else 1
+    for row in csv.reader(lines[1:-1]):
+        try:
+            if len(row) != len(_historyColumns):
+                raise ValueError(row)
+            date = datetime.date.fromisoformat(row[0]).isoformat()
+            counts = tuple(int(count) for count in row[3:])
+        except ValueError:
+            skipped = skipped + 1
+            continue
+        _addHistoryEntry((row[1], row[2]), date, counts)
+    if skipped:
+        logging.info('History load: skipped ' + str(skipped) + ' rows')
+        _storeHistory()
+
+
+def _addHistoryEntry(key, date, counts):
+    """ Records the counts of key on date, returns False if they did not
+    change """
+    """ Callers must hold the history lock """
+    entries = _history.setdefault(key, [])
+    if entries and entries[-1][1] == counts:
+        return False
+    # Only the last counts of a day are shown
+    if entries and entries[-1][0] == date:
+        entries[-1] = (date, counts)
+    else:
+        entries.append((date, counts))
+    return True
+
+
+def _pruneHistory(today):
+    """ Drops the changes older than historyMaxDays, once a day """
+    """ Callers must hold the history lock. The last change before the
+    cutoff is kept to carry its counts forward """
+    global _historyPrunedDate
+    if _historyPrunedDate == today:
+        return
+    _historyPrunedDate = today
+    cutoff = (datetime.date.fromisoformat(today) -
+              datetime.timedelta(days=historyMaxDays)).isoformat()
+    pruned = False
+    for key, entries in _history.items():
+        first = bisect.bisect_right([date for date, counts in entries],
+                                    cutoff) - 1
+        if first > 0:
+            del entries[:first]
+            pruned = True
+    if pruned:
+        _storeHistory()
+
+
+def _getHistoryLine(date, key, counts):
+    """ Returns a row of the history file """
+    line = io.StringIO()
+    csv.writer(line, lineterminator='\n').writerow([date, *key, *counts])
+    return line.getvalue()
+
+
+def _storeHistory():
+    """ Rewrites the history file from the history in memory """
+    """ Callers must hold the history lock. The file is replaced atomically
+    like stored snapshots """
+    if historyFile is None:
+        return
+    rows = sorted((date, key, counts) for key, entries in _history.items()
+                  for date, counts in entries)
+    directory = os.path.dirname(os.path.abspath(historyFile))
+    try:
+        fd, tempFile = tempfile.mkstemp(dir=directory, prefix='history.')
+        try:
+            with os.fdopen(fd, 'w', newline='') as f:
+                f.write(','.join(_historyColumns) + '\n')
+                f.writelines(_getHistoryLine(*row) for row in rows)
+            os.replace(tempFile, historyFile)
+        except BaseException:
+            os.remove(tempFile)
+            raise
+    except OSError:
+        logging.info('History store: FAILED')
+
+
+def _ingestHistory(key, data):
+    """ Appends the counts of a new snapshot that changed since the last
+    one to the history """
+    """ Runs in time proportional to the snapshot, not to the history """
+    if key == 'national':
+        rows = pd.DataFrame({'State_code': data['State_code'],
+                             'District': ''})
+        for column in _countColumns:
+            rows[column] = data[column]
     else:
-        # Retrieve data from web site
+        rows = data[['State_Code', 'District'] + _countColumns[:2] +
+                    ['Deceased', 'Confirmed']]
+        rows = rows.rename(columns={'State_Code': 'State_code',
+                                    'Deceased': 'Deaths'})
+    rows = rows.dropna().drop_duplicates(subset=['State_code', 'District'])
+    rows = rows.set_index(['State_code', 'District'])[_countColumns]
+    today = datetime.date.today().isoformat()
+
+    with _historyLock:
+        _loadHistory()
+        _pruneHistory(today)
+        lines = [_getHistoryLine(today, rowKey, tuple(counts))
+                 for rowKey, counts in zip(rows.index.tolist(),
+                                           rows.to_numpy('int64').tolist())
+                 if _addHistoryEntry(rowKey, today, tuple(counts))]
+        if not lines:
+            return
+        if historyFile is not None:
+            try:
+                header = not os.path.exists(historyFile)
+                with open(historyFile, 'a', newline='') as f:
+                    f.write((','.join(_historyColumns) + '\n' if header
+                             else '') + ''.join(lines))
+            except OSError:
+                logging.info('History store: FAILED')
+    logging.info('History: ' + str(len(lines)) + ' changes from ' + key)
+
+
+def _getHistory(stateCode, district=''):
+    """ Returns the (date, counts) changes recorded for a state, or for one
+    of its districts """
+    with _historyLock:
+        _loadHistory()
+        return list(_history.get((stateCode, district), []))
+
+
+class _TokenBucket:
+    """ Allows rate sends per second with bursts of up to burst sends """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.monotonic()
+
+    def wait(self):
+        """ Returns seconds to wait until a token is available """
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """ Takes a token, returns seconds to wait if none is available """
+        wait = self.wait()
+        if wait <= 0:
+            self.tokens = self.tokens - 1
+        return wait
+
+
+def _getChatBucket(chatId):
+    """ Returns the token bucket of a chat """
+    """ Callers must hold the send condition """
+    bucket = _sendChatBuckets.get(chatId)
+    if bucket is None:
+        if len(_sendChatBuckets) > 10000:
+            # Forget chats whose buckets have refilled
+            now = time.monotonic()
+            for idleChatId in [key for key, value in _sendChatBuckets.items()
+                               if now - value.time > sendChatBurst /
+                               sendChatRate]:
+                del _sendChatBuckets[idleChatId]
+        bucket = _TokenBucket(sendChatRate, sendChatBurst)
+        _sendChatBuckets[chatId] = bucket
+    return bucket
+
+
+def _enqueueSend(method, chatId, kwargs, priority, onSent=None):
+    """ Queues a call to the Telegram API for the sender threads """
+    """ onSent is called with the result of the call once it succeeds """
+    global _sendCount
+    global _sendGlobalBucket
+    with _sendCondition:
+        _sendCount = _sendCount + 1
+        _sendQueue.append({'priority': priority, 'count': _sendCount,
+                           'ready': time.monotonic(),
+                           'method': method, 'chatId': chatId,
+                           'kwargs': kwargs, 'onSent': onSent,
+                           'attempt': 0})
+        if not _sendThreads:
+            _sendGlobalBucket = _TokenBucket(sendGlobalRate, sendGlobalRate)
+            for i in range(sendThreads):
+                thread = threading.Thread(target=_sendLoop,
+                                          name='sender-' + str(i),
+                                          daemon=True)
+                thread.start()
+                _sendThreads.append(thread)
+        _sendCondition.notify()
+
+
+def _requeueSend(item, delay=0):
+    """ Puts a call that could not be sent back in the queue """
+    with _sendCondition:
+        item['ready'] = time.monotonic() + delay
+        _sendQueue.append(item)
+        _sendCondition.notify()
+
+
+def _sendMessage(bot, priority=sendPriorityReply, **kwargs):
+    """ Queues bot.send_message(**kwargs) and returns immediately """
+    _enqueueSend(bot.send_message, kwargs['chat_id'], kwargs, priority)
+
+
+def _forwardMessage(bot, priority=sendPriorityReply, **kwargs):
+    """ Queues bot.forward_message(**kwargs) and returns immediately """
+    _enqueueSend(bot.forward_message, kwargs['chat_id'], kwargs, priority)
+
+
+def _nextSend():
+    """ Waits for the most urgent queued call that may be sent now """
+    """ Calls to a chat that already has one in flight wait for it, so
+    every chat gets its messages in order """
+    with _sendCondition:
+        while True:
+            now = time.monotonic()
+            wait = _sendPausedUntil - now
+            if wait <= 0:
+                queued = [item for item in _sendQueue
+                          if item['chatId'] not in _sendBusyChats]
+                ready = [item for item in queued if item['ready'] <= now]
+                if ready:
+                    item = min(ready, key=lambda item: (item['priority'],
+                                                        item['count']))
+                    chatBucket = _getChatBucket(item['chatId'])
+                    wait = chatBucket.wait()
+                    if wait > 0:
+                        item['ready'] = now + wait
+                        continue
+                    # Tokens are only taken once both buckets have one
+                    wait = _sendGlobalBucket.wait()
+                    if wait <= 0:
+                        chatBucket.take()
+                        _sendGlobalBucket.take()
+                        _sendQueue.remove(item)
+                        _sendBusyChats.add(item['chatId'])
+                        return item
+                elif queued:
+                    wait = min(item['ready'] for item in queued) - now
+                else:
+                    wait = None
+            _sendCondition.wait(wait)
+
+
+def _sendLoop():
+    """ Sends queued calls as fast as Telegram allows """
+    """ Each sender thread makes one call at a time, the token buckets
+    shared under the send condition keep all of them within the limits """
+    while True:
+        item = _nextSend()
         try:
-            req = urllib3.PoolManager()
-            MOHFWPage = req.request('GET', MOHFWLink)
-            soup = BeautifulSoup(MOHFWPage.data, 'html.parser')
-            divTag = soup.find('table', attrs={'class': 'table table-striped'})
-            rows = divTag.findAll('tr')
-            # Discard first row containing header
-            rows = rows[1:]
-
-            stateName = []
-            active = []
-            recovered = []
-            deaths = []
-            confirmed = []
-            for row in rows:
-                cols = row.findAll('td')
-                if len(cols) == 6:
-                    stateName.append(cols[1].text)
-                    active.append(cols[2].text)
-                    recovered.append(cols[3].text)
-                    deaths.append(cols[4].text)
-                    confirmed.append(cols[5].text)
-
-
-            logging.info('Stats retrieval: SUCCESS')
-            return stateName, active, recovered, deaths, confirmed
-        except:
-            logging.info('Stats retrieval: FAILED')
-            return None
+            _sendItem(item)
+        except Exception:
+            # Nothing may stop a sender thread, or replies would stall
+            logging.exception('Send to ' + str(item['chatId']) + ': FAILED')
+        finally:
+            with _sendCondition:
+                _sendBusyChats.discard(item['chatId'])
+                _sendCondition.notify_all()
+
+
+def _pauseSends(chatId, seconds):
+    """ Holds the calls to a chat Telegram throttled for seconds """
+    """ Telegram does not say whether a limit is per chat, so sends to every
+    chat are only paused when another chat is throttled at the same time """
+    global _sendPausedUntil
+    with _sendCondition:
+        now = time.monotonic()
+        until = now + seconds
+        for pausedChatId in [key for key, value in _sendChatPauses.items()
+                             if value <= now]:
+            del _sendChatPauses[pausedChatId]
+        if any(key != chatId for key in _sendChatPauses):
+            _sendPausedUntil = max(_sendPausedUntil, until)
+        _sendChatPauses[chatId] = until
+        # Drain the bucket so the chat gets no token until the pause ends
+        bucket = _getChatBucket(chatId)
+        bucket.wait()
+        bucket.tokens = 1 - seconds * bucket.rate
+
+
+def _sendItem(item):
+    """ Makes a queued call, requeueing it if Telegram asks to retry """
+    method = getattr(item['method'], '__name__', 'unknown')
+    _observe('send_wait_seconds', method, time.monotonic() - item['ready'])
+    try:
+        with _measure('send', method):
+            result = item['method'](**item['kwargs'])
+    except RetryAfter as e:
+        logging.info('Send to ' + str(item['chatId']) + ' throttled for ' +
+                     str(e.retry_after) + 's')
+        _pauseSends(item['chatId'], e.retry_after)
+        _requeueSend(item, delay=e.retry_after)
+    except NetworkError:
+        item['attempt'] = item['attempt'] + 1
+        if item['attempt'] < sendMaxAttempts:
+            _requeueSend(item, delay=2**item['attempt'])
+        else:
+            logging.info('Send to ' + str(item['chatId']) + ': FAILED')
+    except Exception:
+        logging.info('Send to ' + str(item['chatId']) + ': FAILED')
+    else:
+        if item['onSent'] is not None:
+            item['onSent'](result)
+
+
+def _loadSubscriptions():
+    """ Loads the chats subscribed to each alert topic """
+    global _subscriptions
+    if subscriptionsFile is None or not os.path.exists(subscriptionsFile):
+        return
+    try:
+        with open(subscriptionsFile, 'r') as f:
+            subscriptions = json.load(f)
+    except (OSError, ValueError):
+        logging.info('Subscriptions load: FAILED')
+        return
+    with _subscriptionsLock:
+        _subscriptions = {topic: set(chatIds)
+                          for topic, chatIds in subscriptions.items()}
+
+
+def _storeSubscriptions():
+    """ Writes the subscriptions to disk """
+    """ Callers must hold the subscriptions lock """
+    if subscriptionsFile is None:
+        return
+    subscriptions = {topic: sorted(chatIds)
+                     for topic, chatIds in _subscriptions.items() if chatIds}
+    try:
+        tempFile = subscriptionsFile + '.tmp'
+        with open(tempFile, 'w') as f:
+            json.dump(subscriptions, f)
+        os.replace(tempFile, subscriptionsFile)
+    except OSError:
+        logging.info('Subscriptions store: FAILED')
+
+
+def _loadAlertedDrift():
+    """ Loads the differences last alerted, so a restart does not alert
+    subscribers about them again """
+    global _alertedDrift
+    if alertedDriftFile is None or not os.path.exists(alertedDriftFile):
+        return
+    try:
+        with open(alertedDriftFile, 'r') as f:
+            alertedDrift = json.load(f)
+    except (OSError, ValueError):
+        logging.info('Alerted drift load: FAILED')
+        return
+    _alertedDrift = {topic: pd.Series(drift, dtype='int64')
+                     for topic, drift in alertedDrift.items()}
+
+
+def _storeAlertedDrift():
+    """ Writes the differences last alerted to disk """
+    """ Only the alert thread calls it """
+    if alertedDriftFile is None:
+        return
+    alertedDrift = {topic: {stateCode: int(value)
+                            for stateCode, value in drift.items()}
+                    for topic, drift in _alertedDrift.items()}
+    try:
+        tempFile = alertedDriftFile + '.tmp'
+        with open(tempFile, 'w') as f:
+            json.dump(alertedDrift, f)
+        os.replace(tempFile, alertedDriftFile)
+    except OSError:
+        logging.info('Alerted drift store: FAILED')
+
+
+def _subscribe(chatId, topic, enable=True):
+    """ Adds or removes a chat from the subscribers of topic """
+    with _subscriptionsLock:
+        chatIds = _subscriptions.setdefault(topic, set())
+        if enable:
+            chatIds.add(chatId)
+        else:
+            chatIds.discard(chatId)
+        _storeSubscriptions()
+
+
+def _getSubscriptionTopic(args):
+    """ Returns the alert topic named by command arguments, None if invalid """
+    topic = " ".join(args).strip().upper()
+    if topic in ('MOHFW', 'NDMA'):
+        return topic.lower()
+    if len(topic) > 1:
+        return _getStateKey(topic)
+    return None
+
+
+def _getStateChanges(previous, data):
+    """ Returns alert lines per state code for states whose counts changed
+    by at least alertThreshold between two national snapshots """
+    previous = _getStateCounts(previous)
+    changes = {}
+    for stateCode, counts in _getStateCounts(data).items():
+        before = previous.get(stateCode)
+        if before is None or before.confirmed is None or \
+                counts.confirmed is None:
+            continue
+        delta = counts.confirmed - before.confirmed
+        if abs(delta) < alertThreshold:
+            continue
+        changes[stateCode] = \
+            _stateNameByCode.get(stateCode, stateCode)[0:14].ljust(14, '.') \
+            + '|' + '{0:+}'.format(delta).ljust(8, ' ') \
+            + '|' + str(counts.confirmed).ljust(9, ' ') \
+            + '|' + '{0:+}'.format((counts.deaths or 0) -
+                                   (before.deaths or 0))
+    return changes
+
+
+def _getDriftChanges(topic, dataSITE, dataOther):
+    """ Returns alert lines for states whose confirmed cases differ between
+    covid19india.org and another source by a new amount """
+    """ Only differences of at least alertThreshold that moved by
+    alertThreshold since they were last alerted are returned """
+    data = _joinStatewise(dataSITE, dataOther, '_OTHER')
+    drift = (data['Confirmed_OTHER'] - data['Confirmed'])
+    drift.index = data['State_code']
+    drift = drift.dropna().astype('int64')
+    alerted = _alertedDrift.get(topic)
+    if alerted is None:
+        alerted = pd.Series(0, index=drift.index, dtype='int64')
+    moved = (drift - alerted.reindex(drift.index).fillna(0)).abs()
+    changed = drift[(drift.abs() >= alertThreshold) &
+                    (moved >= alertThreshold)]
+    _alertedDrift[topic] = drift.where(
+        drift.index.isin(changed.index),
+        alerted.reindex(drift.index).fillna(0).astype('int64'))
+    return ['{0}|{1:+}'.format(stateCode, value)
+            for stateCode, value in changed.items()]
+
+
+def _checkAlerts(key, previous, data):
+    """ Sends alerts about a new snapshot to subscribed chats """
+    """ Each change is computed once and every chat gets one message with
+    all of the changes it is subscribed to """
+    messages = collections.defaultdict(list)
+    with _subscriptionsLock:
+        subscriptions = {topic: set(chatIds)
+                         for topic, chatIds in _subscriptions.items()}
+
+    if key == 'national' and previous is not None:
+        changes = _getStateChanges(previous, data)
+        for stateCode, line in changes.items():
+            for chatId in subscriptions.get(stateCode, ()):
+                messages[chatId].append(line)
+
+    for topic, source in [('mohfw', 'mohfwapi'), ('ndma', 'ndma')]:
+        if key not in ('national', source) or not subscriptions.get(topic):
+            continue
+        dataSITE = _snapshots.get('national')
+        dataOther = _snapshots.get(source)
+        if dataSITE is None or dataOther is None:
+            continue
+        lines = _getDriftChanges(topic, dataSITE['data'], dataOther['data'])
+        if lines:
+            _storeAlertedDrift()
+            lines = [topic.upper() + ' - covid19india.org (CNFRD)'] + lines
+            for chatId in subscriptions[topic]:
+                messages[chatId].extend(lines)
+
+    for chatId, lines in messages.items():
+        message = '```\nAlert\n\n' + '\n'.join(lines) + '\n```'
+        _sendMessage(_alertBot, priority=sendPriorityBroadcast,
+                     chat_id=chatId, text=message,
+                     parse_mode=ParseMode.MARKDOWN,
+                     disable_web_page_preview=True)
+    if messages:
+        logging.info('Alerts sent to ' + str(len(messages)) + ' chats')
+
+
+def _onSnapshotChanged(key, previous, data):
+    """ Updates everything derived from a new version of a snapshot """
+    if key in ('national', 'district'):
+        _ingestHistory(key, data)
+    if _alertBot is not None and key in ('national', 'mohfwapi', 'ndma'):
+        _alertExecutor.submit(_checkAlerts, key, previous, data)
+    _scheduleInlineResults(key)
+
+
+def _scheduleInlineResults(key):
+    """ Rebuilds the inline query answers if they show the data of key """
+    if key in ('national', 'district', 'mohfwapi'):
+        _inlineExecutor.submit(_buildInlineResults)
+
+
+def _newInlineResult(resultId, title, description, message):
+    """ Returns an inline query result that sends message """
+    return InlineQueryResultArticle(
+        id=resultId, title=title, description=description,
+        input_message_content=InputTextMessageContent(
+            message, parse_mode=ParseMode.MARKDOWN,
+            disable_web_page_preview=True))
+
+
+def _buildInlineResults():
+    """ Renders the answer to inline queries for every state, the national
+    stats and their diff. with MOHFW from the current snapshots """
+    global _inlineResults
+    snapshots = {key: _snapshots.get(key)
+                 for key in ['national', 'district', 'mohfwapi']}
+    data = {key: None if snapshot is None else snapshot['data']
+            for key, snapshot in snapshots.items()}
+    if data['national'] is None:
+        return
+    try:
+        results = {}
+        results['national'] = _newInlineResult(
+            'national', 'India', 'Stats of all states',
+            _getMessageNational(data['national']))
+        if data['mohfwapi'] is not None:
+            results['comparemohfw'] = _newInlineResult(
+                'comparemohfw', 'MOHFW', 'Diff. of MOHFW with ' + webPageLink,
+                _getMessageMOHFWAPI(data['national'], data['mohfwapi'], True))
+        counts = _getStateCounts(data['national'])
+        for stateCode, stateName in _stateNameByCode.items():
+            # The national result already covers the total
+            if stateCode == 'TT' or stateCode not in counts:
+                continue
+            row = counts[stateCode]
+            description = 'Confirmed ' + str(row.confirmed) + \
+                ', Active ' + str(row.active) + \
+                ', Recovered ' + str(row.recovered) + \
+                ', Deaths ' + str(row.deaths)
+            if data['district'] is not None:
+                message = _getMessageStatewise(data['district'], stateCode)
+            else:
+                message = stateName + '\n' + description
+            results[stateCode] = _newInlineResult(
+                stateCode, stateName + ' (' + stateCode + ')', description,
+                message)
+    except Exception:
+        logging.info('Inline results: FAILED')
+        return
+    _inlineResults = results
+
+
+def _getInlineResultKeys(query):
+    """ Returns the keys of the results whose state or keyword starts with
+    query, in index order """
+    prefix = _normalizeStateName(query)
+    keys = []
+    start = bisect.bisect_left(_inlineIndex, (prefix,))
+    for key, resultKey in _inlineIndex[start:]:
+        if not key.startswith(prefix):
+            break
+        if resultKey not in keys:
+            keys.append(resultKey)
+    return keys
+
+
+def inlineQuery(update, context):
+    """ Answers inline queries from the prebuilt results """
+    query = update.inline_query.query
+    results = _inlineResults
+    if query.strip():
+        keys = _getInlineResultKeys(query)
+    else:
+        keys = ['national', 'comparemohfw'] + list(_stateNameByCode)
+    answer = [results[key] for key in keys if key in results][:50]
+    # Answered right away, inline queries are not sent to a chat
+    update.inline_query.answer(answer, cache_time=inlineCacheTime)
+
+
+def _newFigure(rows):
+    """ Returns a figure tall enough for rows bars, drawn without a display """
+    """ matplotlib is imported on first use since only charts need it """
+    from matplotlib.figure import Figure
+    return Figure(figsize=(8, 1.5 + 0.25 * rows), dpi=100)
 
-def _getNDMAData(site=False):
-    """ Retrieves data from NDMA API or site """
-    logging.info('Command invoked: getNDMAData')
-    if site:
-        return None
+
+def _getFigurePNG(figure):
+    """ Returns the PNG image of a figure """
+    figure.tight_layout()
+    image = io.BytesIO()
+    figure.savefig(image, format='png')
+    return image.getvalue()
+
+
+def _getSnapshotDigest(snapshot):
+    """ Returns a hash of the data of a snapshot, computed once per version """
+    if 'digest' not in snapshot:
+        data = snapshot['data']
+        snapshot['digest'] = hashlib.sha256(
+            repr(list(data.columns)).encode() +
+            pd.util.hash_pandas_object(data).to_numpy().tobytes()).digest()
+    return snapshot['digest']
+
+
+def _loadChartFileIds():
+    """ Loads the file_id of every chart uploaded earlier """
+    if chartFileIdsFile is None or not os.path.exists(chartFileIdsFile):
+        return
+    try:
+        with open(chartFileIdsFile, 'r') as f:
+            fileIds = json.load(f)
+    except (OSError, ValueError):
+        logging.info('Chart file ids load: FAILED')
+        return
+    with _chartFileIdsLock:
+        _chartFileIds.update(fileIds)
+
+
+def _storeChartFileIds():
+    """ Writes the file_id of uploaded charts to disk """
+    """ Callers must hold the chart file ids lock """
+    if chartFileIdsFile is None:
+        return
+    try:
+        tempFile = chartFileIdsFile + '.tmp'
+        with open(tempFile, 'w') as f:
+            json.dump(_chartFileIds, f)
+        os.replace(tempFile, chartFileIdsFile)
+    except OSError:
+        logging.info('Chart file ids store: FAILED')
+
+
+def _setChartFileId(digest, fileId):
+    """ Remembers or, when fileId is None, forgets the upload of a chart """
+    with _chartFileIdsLock:
+        if fileId is None:
+            if _chartFileIds.pop(digest, None) is None:
+                return
+        else:
+            _chartFileIds[digest] = fileId
+            while len(_chartFileIds) > chartFileIdsSize:
+                _chartFileIds.popitem(last=False)
+        _storeChartFileIds()
+
+
+def _sendChart(bot, chatId, name, sources, draw):
+    """ Sends the chart drawn by draw() from the data of sources """
+    """ Charts are addressed by a hash of their name and data. Once one has
+    been uploaded its file_id is sent instead, without drawing it again """
+    snapshots = _getSnapshots(sources)
+    if any(snapshots[source] is None for source in sources):
+        _sendMessage(bot, chat_id=chatId,
+                     text='Data is unavailable. Please try later.')
+        return
+    digest = hashlib.sha256(repr(name).encode() + b''.join(
+        _getSnapshotDigest(snapshots[source]) for source in sources)) \
+        .hexdigest()
+    with _chartFileIdsLock:
+        fileId = _chartFileIds.get(digest)
+    if fileId is not None:
+        _count('chart_uploads_reused', name[0])
+        image = None
+    elif importlib.util.find_spec('matplotlib') is None:
+        _sendMessage(bot, chat_id=chatId, text='Charts are unavailable.')
+        return
     else:
-        # Retrieve data from API
+        image = _getCachedMessage(('chart',) + name, sources, draw)
+
+    def send_photo(**kwargs):
+        # An upload reads the file to its end, so each attempt gets its own
+        if image is not None:
+            return bot.send_photo(photo=io.BytesIO(image), **kwargs)
         try:
-            data = requests.get(NDMALink).json()
-            logging.info('Stats retrieval: SUCCESS')
-            return data['features']
-        except:
-            logging.info('Stats retrieval: FAILED')
+            return bot.send_photo(photo=fileId, **kwargs)
+        except BadRequest as e:
+            message = str(e).lower()
+            if 'file identifier' not in message and \
+                    'file reference' not in message:
+                raise
+            # The upload is gone, draw and upload it again on a worker
+            # since this runs on a sender thread
+            _setChartFileId(digest, None)
+            _chartExecutor.submit(_sendChart, bot, chatId, name, sources,
+                                  draw)
             return None
 
+    def onSent(message):
+        if image is not None:
+            _setChartFileId(digest, message.photo[-1].file_id)
+
+    _enqueueSend(send_photo, chatId, {'chat_id': chatId}, sendPriorityReply,
+                 onSent)
+
+
 def _readToken(filename):
     """ Read secret Bot TOKEN from file """
     with open(filename, 'r') as f:
@@ -117,34 +1771,10 @@ def _readToken(filename):
         return TOKEN
 
 
-def _getSortedStatewise(data):
-    """ Returns ordered statewise data on the basis of max confirmed"""
-    stateConfirmed = {}
-    for state in data:
-        totalConfirmed = 0
-        for district in state['districtData']:
-            totalConfirmed = totalConfirmed + int(district['confirmed'])
-        stateConfirmed[state['state']] = totalConfirmed
-    sortedData = sorted(stateConfirmed.items(), key=operator.itemgetter(1),
-                        reverse=True)
-    return(sortedData)
-
-
-def _getSortedNational(data, keyBasis='active'):
-    """ Returns ordered national data on the basis of max confirmed"""
-    stateValue = {}
-    for state in data['statewise']:
-        stateName = str(state['state'])
-        value = int(state[keyBasis])
-        stateValue[stateName] = value
-    orderedData = sorted(stateValue.items(), key=operator.itemgetter(1),
-                         reverse=True)
-    return(orderedData)
-
-
-def _getMessageNational():
+def _getMessageNational(data):
     """ Returns formatted data for printing """
-    data = _getSiteData()
+    if data is None:
+        return 'Data is unavailable. Please try later.'
     orderedData = data.sort_values(by=['Active'], ascending=False)
     chars = 5  # Character spacing per column
     message = '\n' \
@@ -157,55 +1787,175 @@ def _getMessageNational():
     + 'ACTI'.ljust(5, '.') + '\n'\
     + '------|-----|-----|-----|-----\n'
 
-    # print(orderedData.columns)  # DEBUG
-    for index, state in orderedData.iterrows():
-        stateName = state["State"]
-        active = orderedData["Active"][index]
-        confirmed = orderedData["Confirmed"][index]
-        deaths = orderedData["Deaths"][index]
-        recovered = orderedData["Recovered"][index]
-
-        # Clean up and formatting
-        if stateName.strip() != "Total":
-            stateName = stateName[0:6].ljust(6, ' ')
-        else:
-            stateName = 'INDIA.'
-        active = str(active).ljust(chars, ' ')
-        confirmed = str(confirmed).ljust(chars, ' ')
-        deaths = str(deaths).ljust(chars, ' ')
-        recovered = str(recovered).ljust(chars, ' ')
-        # deltaconfirmed = state["deltaconfirmed"]
-        # deltadeaths    = state["deltadeaths"]
-        # deltarecovered = state["deltarecovered"]
-        message = message + stateName + '|' \
-            + confirmed + '|' + recovered + '|' \
-            + deaths + '|' + active + '\n'
-    message = '```' + message + '```'
+    # Clean up and formatting
+    stateName = orderedData['State'].astype(str)
+    stateName = stateName.str[0:6].str.ljust(6, ' ') \
+        .where(stateName.str.strip() != 'Total', 'INDIA.')
+    columns = [stateName] + \
+        [orderedData[column].astype(str).str.ljust(chars, ' ')
+         for column in ['Confirmed', 'Recovered', 'Deaths', 'Active']]
+    message = '```' + message + _joinColumns(columns) + '```'
     return message
 
 
-def _getMessageStatewise(stateName):
-    data = _getSiteData(statewise=True)
+def _drawNational(data):
+    """ Returns a chart of the counts of each state """
+    states = data[data['State_code'] != 'TT'].sort_values(by=['Confirmed'])
+    figure = _newFigure(len(states))
+    axes = figure.subplots()
+    left = 0
+    for column in ['Active', 'Recovered', 'Deaths']:
+        axes.barh(states['State'].astype(str), states[column], left=left,
+                  label=column)
+        left = left + states[column]
+    axes.set_title(webPageLink)
+    axes.legend(loc='lower right')
+    axes.margins(y=0.01)
+    return _getFigurePNG(figure)
+
+
+def _getDistrictIndex(data):
+    """ Returns district data grouped by state code along with the districts
+    that have invalid values, built once per district snapshot """
+    global _districtIndex
+    with _districtIndexLock:
+        if _districtIndex.get('data') is data:
+            return _districtIndex
+
+        districts = data.sort_values(by='State_Code', kind='mergesort') \
+            .reset_index(drop=True)
+        # Rows of each state are contiguous once sorted
+        stateCodes = districts['State_Code']
+        bounds = stateCodes.ne(stateCodes.shift()).to_numpy().nonzero()[0]
+        bounds = bounds.tolist() + [len(districts)]
+        ranges = {stateCodes[start]: (start, stop)
+                  for start, stop in zip(bounds, bounds[1:])}
+
+        unknown = districts['District'] == 'Unknown'
+        unassigned = unknown & \
+            (districts[['Confirmed', 'Recovered', 'Deceased']] != 0) \
+            .any(axis=1)
+        negative = ~unknown & \
+            (districts[['Confirmed', 'Active', 'Recovered', 'Deceased']] < 0) \
+            .any(axis=1)
+        _districtIndex = {'data': data, 'districts': districts,
+                          'ranges': ranges,
+                          'unknown': districts[unassigned],
+                          'invalid': districts[negative]}
+        return _districtIndex
+
+
+def _getMessageStatewise(data, stateCode):
+    if data is None:
+        return 'Data is unavailable. Please try later.'
     chars = 8
-    for stateDict in data:
-        if stateName == stateDict['state']:
-            message = webPageLink + '\n' +  \
-                'District'.ljust(14,' ') + '|Total Confirmed'.ljust(14,' ') + '\n'
-            for district in stateDict['districtData']:
-                districtName = district['district']
-                confirmed = str(district['confirmed']).ljust(chars, ' ')
-                delta = str(district['delta']['confirmed']).ljust(chars, ' ')
-                message = message + districtName[0:10].ljust(14, '.') \
-                    + '|' + confirmed + '\n'
-            break
-    message = '```' +  message + '```'
+    index = _getDistrictIndex(data)
+    start, stop = index['ranges'].get(stateCode, (0, 0))
+    districts = index['districts'].iloc[start:stop]
+    message = webPageLink + '\n' +  \
+        'District'.ljust(14,' ') + '|Total Confirmed'.ljust(14,' ') + '\n'
+    columns = [districts['District'].astype(str).str[0:10].str.ljust(14, '.'),
+               districts['Confirmed'].astype(str).str.ljust(chars, ' ')]
+    message = '```' +  message + _joinColumns(columns) + '```'
+    return message
+
+def _getMessageHistory(stateCode, days, today):
+    """ Returns daily counts of a state for the last days from history """
+    history = _getHistory(stateCode)
+    if not history:
+        return 'No history has been recorded yet. Please try later.'
+
+    # History only holds changes, so carry counts forward to every day
+    dates = [(today - datetime.timedelta(days=day)).isoformat()
+             for day in range(days, -1, -1)]
+    daily = pd.DataFrame([counts for date, counts in history],
+                         index=[date for date, counts in history],
+                         columns=_countColumns)
+    daily = daily.reindex(daily.index.union(dates)).ffill().reindex(dates)
+    # A day without counts the day before has no known change
+    deltas = daily.diff().iloc[1:].apply(lambda column: column.map(
+        lambda delta: '-' if pd.isna(delta) else '+' + str(int(delta))))
+    daily = daily.iloc[1:]
+    available = daily['Confirmed'].notna()
+    daily = daily[available].astype('int64')
+    deltas = deltas[available]
+
+    chars = 8
+    message = '\n' + webPageLink + '\n' \
+        + ('India' if stateCode == 'TT' else _stateNameByCode[stateCode]) \
+        + ', last ' \
+        + str(days) + ' days\n\n' \
+        + 'DATE.|' + 'CNFRD'.ljust(chars, '.') + '|'\
+        + 'NEW'.ljust(6, '.') + '|'\
+        + 'ACTIV'.ljust(chars, '.') + '|'\
+        + 'DEAD'.ljust(6, '.') + '\n'\
+        + '-----|--------|------|--------|------\n'
+    columns = [pd.Series(daily.index.str[8:10] + '/' + daily.index.str[5:7],
+                         index=daily.index),
+               daily['Confirmed'].astype(str).str.ljust(chars, ' '),
+               deltas['Confirmed'].str.ljust(6, ' '),
+               daily['Active'].astype(str).str.ljust(chars, ' '),
+               deltas['Deaths'].str.ljust(6, ' ')]
+    message = '```' + message + _joinColumns(columns) + '```'
     return message
 
+
+def _getMessageInvalidState(stateName):
+    """ Returns the reply to an unknown state with a suggested code """
+    message = 'Invalid state name.'
+    stateCode = _suggestStateCode(stateName)
+    if stateCode is not None:
+        message = message + ' Did you mean ' + stateCode + ' (' + \
+            _stateNameByCode[stateCode] + ')?'
+    return message + ' Use /statecodes to display codes.'
+
+
 def _initStateCodes(filename):
     global _stateNameCodeDict
+    global _stateNameByCode
+    global _stateKeyIndex
+    global _stateCodesMessage
     with open(filename, 'r') as scFile:
         _stateNameCodeDict = json.load(scFile)
 
+    # Index state codes, normalized state names and their aliases
+    stateNameByCode = {}
+    stateKeyIndex = {}
+    for key, stateName in _stateNameCodeDict.items():
+        if len(key) == 2:
+            stateNameByCode[key] = stateName
+            stateKeyIndex[key] = key
+            stateKeyIndex[_normalizeStateName(stateName)] = key
+    for alias, stateCode in _stateAliases.items():
+        stateKeyIndex[_normalizeStateName(alias)] = stateCode
+    _stateNameByCode = types.MappingProxyType(stateNameByCode)
+    _stateKeyIndex = types.MappingProxyType(stateKeyIndex)
+    _inlineIndex[:] = sorted(list(stateKeyIndex.items()) +
+                             list(_inlineKeywords.items()))
+
+    message = ''
+    for stateCode, stateName in _stateNameByCode.items():
+        message = message + stateCode + ': ' + stateName + '\n'
+    _stateCodesMessage = webPageLink + '```' + '\n\nState codes\n\n' + \
+        message + '```'
+
+def _normalizeStateName(stateName):
+    """ Returns state name in a form comparable across sources """
+    stateName = _removeSpecialChars(stateName).replace('&', ' and ')
+    return ' '.join(stateName.upper().split())
+
+def _getStateKey(stateName):
+    """ Returns state code of a state code or name used by any source """
+    return _stateKeyIndex.get(_normalizeStateName(stateName))
+
+def _suggestStateCode(stateName):
+    """ Returns the state code closest to a misspelt state code or name """
+    matches = difflib.get_close_matches(_normalizeStateName(stateName),
+                                        _stateKeyIndex.keys(), n=1)
+    if matches:
+        return _stateKeyIndex[matches[0]]
+    return None
+
 def _removeSpecialChars(string):
     badChars = ['#', '*', '+']
     for badChar in badChars:
@@ -216,7 +1966,7 @@ def start(update, context):
     """ start command """
     logging.info('Command invoked: start')
     message = 'Use /help for a list of commands.'
-    context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message)
 
 
 def help(update, context):
@@ -225,15 +1975,20 @@ def help(update, context):
 
     message = "/covid19india - Displays stats of all states\n" + \
               "/covid19india <state> - Displays stats of a <state>\n" + \
+              "/covid19india <state> 7d - Displays daily stats of a <state> for 7 days\n" + \
+              "/covid19india chart - Displays stats of all states as a chart\n" + \
               "/statecodes - Displays codes of states that can be used as <state>\n" + \
               "/mohfw - Displays data from MOHFW database\n" + \
               "/comparemohfw - Displays the diff. in cases reported by MOHFW database\n" + \
               "(-ve) means MOHFW reports lesser cases and\n(+ve) means MOHFW " + \
               " reports higher cases than covid19india.org\n" + \
+              "/comparemohfw chart - Displays that diff. as a chart\n" + \
+              "/subscribe <mohfw/ndma/state> - Alerts when MOHFW or NDMA drift from covid19india.org or when a <state> changes\n" + \
+              "/unsubscribe <mohfw/ndma/state> - Stops those alerts\n" + \
               "/request - Forward request to @covid19indiaorg_resource_req\n" + \
               "/advanced - Lists commands and options for advanced usage"
 
-    context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message)
 
 def advanced(update, context):
     """ advanced command """
@@ -241,64 +1996,107 @@ def advanced(update, context):
 
     message = "/request <enable/disable> - admin allow/dissallow requests\n" + \
               "/recon - for value checks in data fields.\n" + \
+              "/stats - admin latencies and cache hit rates\n" + \
               " Use the keyword 'api' or 'site' after the commands" + \
               " /mohfw and /comparemohfw for retrieving data directly" + \
               " from the MOHFW website rather than the API provided by MOHFW\n"
 
-    context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message)
 
 
 def statecodes(update, context):
     """ Displays state codes """
     logging.info('Command invoked: statecodes')
-    global _stateNameCodeDict
-    message = ''
-    for stateName in _stateNameCodeDict:
-        if len(stateName) == 2:
-            message = message + stateName + ': ' + \
-                _stateNameCodeDict[stateName] + '\n'
-
-    message = webPageLink + '```'+ '\n\nState codes\n\n' + message + '```'
-
-    context.bot.send_message(chat_id=update.effective_chat.id, text=message,
-                             parse_mode=ParseMode.MARKDOWN,
-                             disable_web_page_preview=True)
-
-
-def getStateCode(stateName):
-    global _stateNameCodeDict
-    stateName = _stateNameCodeDict[stateName.upper()]
-    for key, value in _stateNameCodeDict.items():
-        if stateName == value and len(key) == 2:
-            return key
-    return None
+    _sendMessage(context.bot, chat_id=update.effective_chat.id,
+                 text=_stateCodesMessage,
+                 parse_mode=ParseMode.MARKDOWN,
+                 disable_web_page_preview=True)
 
 
 def covid19india(update, context):
     """ Main command that retrieves and sends data """
     logging.info('Command invoked: covid19india')
     # Check for arguments
-    stateName = "".join(context.args).strip().upper()
-    if len(stateName) > 1:  # State data requested
-        try:
-            stateName = _stateNameCodeDict[stateName]
-            message = _getMessageStatewise(stateName)
-        except KeyError:
-            message = 'Invalid state name. Use /statecodes to display codes.'
+    args = context.args
+    days = None
+    if args and re.match(r'^[0-9]+[dD]$', args[-1]):
+        days = max(1, min(int(args[-1][:-1]), historyMaxDays))
+        args = args[:-1]
+    stateName = " ".join(args).strip().upper()
+    if stateName == 'CHART':
+        _sendChart(context.bot, update.effective_chat.id, ('national',),
+                   ['national'], _drawNational)
+        return
+    if days is not None:  # History requested
+        stateCode = 'TT' if len(stateName) <= 1 else _getStateKey(stateName)
+        if stateCode is not None:
+            today = datetime.date.today()
+            message = _getCachedMessage(
+                ('history', stateCode, days, today), ['national'],
+                lambda data: _getMessageHistory(stateCode, days, today))
+        else:
+            message = _getMessageInvalidState(stateName)
+    elif len(stateName) > 1:  # State data requested
+        stateCode = _getStateKey(stateName)
+        if stateCode is not None:
+            message = _getCachedMessage(
+                ('statewise', stateCode), ['district'],
+                lambda data: _getMessageStatewise(data, stateCode))
+        else:
+            message = _getMessageInvalidState(stateName)
     else:  # National data requested
-        message = _getMessageNational()
-
-    context.bot.send_message(chat_id=update.effective_chat.id, text=message,
-                             parse_mode=ParseMode.MARKDOWN,
-                             disable_web_page_preview=True)
-
-def mohfwapi(update, context, compare=False):
-    """ Compares covid19india.org data with MOHFW database """
-    logging.info('Command invoked: mohfwapi')
-    # Check for arguments
-    dataSITE_raw = _getSiteData()
+        message = _getCachedMessage(('national',), ['national'],
+                                    _getMessageNational)
+
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message,
+                 parse_mode=ParseMode.MARKDOWN,
+                 disable_web_page_preview=True)
+
+def _joinStatewise(dataSITE, dataOther, suffix):
+    """ Joins covid19india.org statewise data with another source """
+    """ Counts of the other source get suffix appended to their column names
+    and are missing for states that it does not report """
+    if dataOther is None:
+        # Typed like the data of other sources, object counts would be
+        # downcast by fillna when formatted
+        dataOther = _newStatewise([], [], [], [], [])
+    return dataSITE.merge(dataOther, how='left', on='State_code',
+                          suffixes=('', suffix))
+
+
+def _formatCountColumns(data, columns, suffix, compare, chars=6):
+    """ Returns formatted counts of another source, or their diff. with
+    covid19india.org counts, from joined statewise data """
+    cells = []
+    for column in columns:
+        values = data[column + suffix]
+        if compare == True:
+            values = values - data[column]
+        column = values.astype('string')
+        if compare == True:
+            column = column.where(values.fillna(-1) < 0, '+' + column)
+        column = column.str.ljust(chars, ' ')
+        if compare == True:
+            # Change +0 to _0
+            column = column.mask(values.fillna(-1) == 0, zeroCode)
+        cells.append(column.fillna(unavblCode).astype(str))
+    return cells
+
+
+def _joinColumns(columns):
+    """ Joins columns of formatted cells into table rows """
+    rows = columns[0]
+    for column in columns[1:]:
+        rows = rows + '|' + column
+    return ''.join(rows + '\n')
+
+
+def _getMessageMOHFWAPI(dataSITE_raw, dataMOHFW, compare=False):
+    """ Returns MOHFW API data, or its diff. with covid19india.org data """
+    if dataSITE_raw is None:
+        return 'Data is unavailable. Please try later.'
     dataSITE = dataSITE_raw.sort_values(by=['Active'], ascending=False)
-    dataMOHFW = _getMOHFWData()
+    data = _joinStatewise(dataSITE, dataMOHFW, '_MOHFW')
     message = '\nMOHFW Reports (API): ' \
         + '\n\n' \
         + 'ST' + '|'\
@@ -307,102 +2105,63 @@ def mohfwapi(update, context, compare=False):
         + 'DECSD'.ljust(6, '.') + '|'\
         + 'CNFRD'.ljust(6, '.') + '\n'\
         + '--|------|------|------|------\n'
-    chars = 6
 
-    try:
-        for index, state in dataSITE.iterrows():
-            stateSITE = state['State']
-            activeSITE = dataSITE['Active'][index]
-            confirmedSITE = dataSITE['Confirmed'][index]
-            deathsSITE = dataSITE['Deaths'][index]
-            recoveredSITE = dataSITE['Recovered'][index]
-
-            confirmedMOHFW = 'UNAVBL'
-            for stateDict in dataMOHFW:
-                stateMOHFW = str(stateDict['state_name'])
-                # Check for matching state name in MOHFW database
-                # 1. Handle Telangana misspelling
-                # 2. Handle Total
-                if stateMOHFW == stateSITE or \
-                   (stateSITE == 'Telangana' and stateMOHFW == 'Telengana'):
-                    activeMOHFW = stateDict['new_active']
-                    recoveredMOHFW = stateDict['new_cured']
-                    deathsMOHFW = stateDict['new_death']
-                    confirmedMOHFW = stateDict['new_positive']
-                    break
-                if stateSITE == 'Total' and stateDict['sno'] == '11111':
-                    activeMOHFW = stateDict['new_active']
-                    recoveredMOHFW = stateDict['new_cured']
-                    deathsMOHFW = stateDict['new_death']
-                    confirmedMOHFW = stateDict['new_positive']
-                    break
-
-            stateCode = getStateCode(stateSITE)
-            if confirmedMOHFW == 'UNAVBL':
-                confirmedMOHFW = unavblCode
-                confirmed_diff = unavblCode
-                active_diff = unavblCode
-                recovered_diff = unavblCode
-                deaths_diff = unavblCode
-                activeMOHFW = unavblCode
-            else:
-                if compare == True:
-                    leadingPlus = '{0:+}'
-                    confirmed_diff = int(confirmedMOHFW) - confirmedSITE
-                    active_diff = int(activeMOHFW) - activeSITE
-                    recovered_diff = int(recoveredMOHFW) - recoveredSITE
-                    deaths_diff = int(deathsMOHFW) - deathsSITE
-                else:
-                    leadingPlus = '{0}'
-                    confirmed_diff = int(confirmedMOHFW)
-                    active_diff = int(activeMOHFW)
-                    recovered_diff = int(recoveredMOHFW)
-                    deaths_diff = int(deathsMOHFW)
-                # String formatting
-                confirmed_diff = leadingPlus.format(confirmed_diff).ljust(chars, ' ')
-                active_diff = leadingPlus.format(active_diff).ljust(chars, ' ')
-                recovered_diff = leadingPlus.format(recovered_diff).ljust(chars, ' ')
-                deaths_diff = leadingPlus.format(deaths_diff).ljust(chars, ' ')
-                # Check for +0 and change to _0
-                if confirmed_diff.strip() == '+0':
-                    confirmed_diff = zeroCode
-                if active_diff.strip() == '+0':
-                    active_diff = zeroCode
-                if recovered_diff.strip() == '+0':
-                    recovered_diff = zeroCode
-                if deaths_diff.strip() == '+0':
-                    deaths_diff = zeroCode
-
-            message = message + \
-                stateCode.ljust(2, '.') + \
-                '|' + active_diff + '|' + recovered_diff + \
-                '|' + deaths_diff + '|' + confirmed_diff + '\n'
-
-        message = '```' + message + '```'
-
-    except TypeError:
-        message = 'Data is unavailable. Please try later.'
-
-    context.bot.send_message(chat_id=update.effective_chat.id, text=message,
-                             parse_mode=ParseMode.MARKDOWN,
-                             disable_web_page_preview=True)
+    cells = _formatCountColumns(data, _countColumns, '_MOHFW', compare)
+    stateCode = data['State_code'].astype(str).str.ljust(2, '.')
+    message = '```' + message + _joinColumns([stateCode] + cells) + '```'
+    return message
+
+
+def _drawCompareMOHFW(dataSITE, dataMOHFW):
+    """ Returns a chart of the diff. of MOHFW counts with covid19india.org """
+    data = _joinStatewise(dataSITE, dataMOHFW, '_MOHFW')
+    data = data[~data['State_code'].isin(['TT', 'UN'])] \
+        .sort_values(by=['State_code'], ascending=False)
+    figure = _newFigure(1.5 * len(data))
+    axes = figure.subplots()
+    columns = ['Confirmed', 'Recovered', 'Deaths']
+    height = 0.8 / len(columns)
+    for i, column in enumerate(columns):
+        values = (data[column + '_MOHFW'] - data[column]).astype('float')
+        axes.barh([row + i * height for row in range(len(data))],
+                  values.fillna(0), height=height, label=column)
+    axes.set_yticks([row + height for row in range(len(data))])
+    axes.set_yticklabels(data['State_code'].astype(str))
+    axes.axvline(0, color='black', linewidth=0.5)
+    axes.set_title('MOHFW minus covid19india.org')
+    axes.legend(loc='lower right')
+    axes.margins(y=0.01)
+    return _getFigurePNG(figure)
+
+
+def mohfwapi(update, context, compare=False):
+    """ Compares covid19india.org data with MOHFW database """
+    logging.info('Command invoked: mohfwapi')
+    message = _getCachedMessage(('mohfwapi', compare),
+                                ['national', 'mohfwapi'],
+                                lambda dataSITE, data: _getMessageMOHFWAPI(
+                                    dataSITE, data, compare))
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message,
+                 parse_mode=ParseMode.MARKDOWN,
+                 disable_web_page_preview=True)
 
 def ndmasite(update, context, compare=False):
     """ Compares covid19india.org data with NDMA website data """
     logging.info('Command invoked: ndmasite')
 
     message = 'FUNCTION NOT IMPLEMENTED'
-    context.bot.send_message(chat_id=update.effective_chat.id, text=message,
-                             parse_mode=ParseMode.MARKDOWN,
-                             disable_web_page_preview=True)
-
-def ndmaapi(update, context, compare=False):
-    """ Compares covid19india.org data with NDMA database """
-    logging.info('Command invoked: ndmaapi')
-    # Check for arguments
-    dataSITE_raw = _getSiteData()
-    dataSITE = _getSortedNational(dataSITE_raw, keyBasis='active')[1:]
-    dataNDMA = _getNDMAData()
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message,
+                 parse_mode=ParseMode.MARKDOWN,
+                 disable_web_page_preview=True)
+
+def _getMessageNDMAAPI(dataSITE_raw, dataNDMA, compare=False):
+    """ Returns NDMA API data, or its diff. with covid19india.org data """
+    if dataSITE_raw is None:
+        return 'Data is unavailable. Please try later.'
+    dataSITE = dataSITE_raw.sort_values(by=['Active'], ascending=False)
+    # Handle "Total" and "State Unassigned"
+    dataSITE = dataSITE[~dataSITE['State_code'].isin(['TT', 'UN'])]
+    data = _joinStatewise(dataSITE, dataNDMA, '_NDMA')
     message = '\nNDMA Reports (API): ' \
         + '\n\n' \
         + 'REGION'.ljust(8, '.') + '|'\
@@ -412,197 +2171,60 @@ def ndmaapi(update, context, compare=False):
         + '--------|------|------|------\n'
     chars = 6
 
-    try:
-        for state in dataSITE:
-            stateSITE = str(state[0])
-            activeSITE = state[1]
-            # Handle "State Unassigned"
-            if (stateSITE == 'State Unassigned'):
-                continue
-            # Obtain deaths and recovered for each state from site dataset
-            for stateDict in dataSITE_raw['statewise']:
-                if stateSITE == stateDict['state']:
-                    confirmedSITE = int(stateDict['confirmed'])
-                    deathsSITE = int(stateDict['deaths'])
-                    recoveredSITE = int(stateDict['recovered'])
-
-            confirmedNDMA = 'UNAVBL'
-            for stateDict in dataNDMA:
-                stateNDMA = str(stateDict['attributes']['state_name'])
-                # Check for matching state name in MOHFW database
-                # 1. Handle Telangana misspelling
-                # 2. Handle Dadra '&' Nagar Haveli
-                # 3. Daman '&' Diu
-                if stateNDMA == stateSITE or \
-                   (stateSITE == 'Telangana' and stateNDMA == 'Telengana') or \
-                   (stateSITE == 'Dadra and Nagar Haveli' and stateNDMA ==
-                    'Dadra & Nagar Haveli') or \
-                   (stateSITE == 'Daman and Diu' and stateNDMA == 'Daman & Diu'):
-                    confirmedNDMA = stateDict['attributes']['confirmedcases']
-                    recoveredNDMA = stateDict['attributes']['cured_discharged_migrated']
-                    deathsNDMA = stateDict['attributes']['deaths']
-            if confirmedNDMA == 'UNAVBL' or (confirmedNDMA == None) or \
-               (recoveredNDMA == None) or (deathsNDMA == None):
-                confirmed_diff = 'UNAVBL'.ljust(chars, ' ')
-                active_diff = 'UNAVBL'.ljust(chars, ' ')
-                recovered_diff = 'UNAVBL'.ljust(chars, ' ')
-                deaths_diff = 'UNAVBL'.ljust(chars, ' ')
-                activeNDMA = 'UNAVBL'.ljust(chars, ' ')
-            else:
-                if compare == True:
-                    leadingPlus = '{0:+}'
-                    confirmed_diff = int(confirmedNDMA) - confirmedSITE
-                    active_diff = int(confirmedNDMA) - int(recoveredNDMA) - \
-                        int(deathsNDMA) - activeSITE
-                    recovered_diff = int(recoveredNDMA) - recoveredSITE
-                    deaths_diff = int(deathsNDMA) - deathsSITE
-                else:
-                    leadingPlus = '{0}'
-                    confirmed_diff = int(confirmedNDMA)
-                    active_diff = int(confirmedNDMA) - int(recoveredNDMA) - \
-                        int(deathsNDMA)
-                    recovered_diff = int(recoveredNDMA)
-                    deaths_diff = int(deathsNDMA)
-                # String formatting
-                confirmed_diff = leadingPlus.format(confirmed_diff).ljust(chars, ' ')
-                active_diff = leadingPlus.format(active_diff).ljust(chars, ' ')
-                recovered_diff = leadingPlus.format(recovered_diff).ljust(chars, ' ')
-                deaths_diff = leadingPlus.format(deaths_diff).ljust(chars, ' ')
-                # Check for +0 and change to _0
-                if confirmed_diff.strip() == '+0':
-                    confirmed_diff = zeroCode
-                if active_diff.strip() == '+0':
-                    active_diff = zeroCode
-                if recovered_diff.strip() == '+0':
-                    recovered_diff = zeroCode
-                if deaths_diff.strip() == '+0':
-                    deaths_diff = zeroCode
-
-            message = message + \
-                stateSITE[0:chars+2].ljust(chars+2, '.') + \
-                '|' + confirmed_diff + '|' + recovered_diff + \
-                '|' + deaths_diff + '\n'
-
-        message = '```' + message + '```'
-
-    except TypeError:
-        message = 'Data is unavailable. Please try later.'
-
-    context.bot.send_message(chat_id=update.effective_chat.id, text=message,
-                             parse_mode=ParseMode.MARKDOWN,
-                             disable_web_page_preview=True)
+    columns = ['Confirmed', 'Recovered', 'Deaths']
+    cells = _formatCountColumns(data, columns, '_NDMA', compare)
+    # Rows with any count missing are unavailable
+    missing = data[[column + '_NDMA' for column in columns]] \
+        .isna().any(axis=1)
+    cells = [column.mask(missing, unavblCode) for column in cells]
+    stateName = data['State'].astype(str).str[0:chars+2] \
+        .str.ljust(chars+2, '.')
+    message = '```' + message + _joinColumns([stateName] + cells) + '```'
+    return message
+
+
+def ndmaapi(update, context, compare=False):
+    """ Compares covid19india.org data with NDMA database """
+    logging.info('Command invoked: ndmaapi')
+    message = _getCachedMessage(('ndmaapi', compare),
+                                ['national', 'ndma'],
+                                lambda dataSITE, data: _getMessageNDMAAPI(
+                                    dataSITE, data, compare))
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message,
+                 parse_mode=ParseMode.MARKDOWN,
+                 disable_web_page_preview=True)
+
+def _getMessageMOHFWSite(dataSITE_raw, dataMOHFW, compare=False):
+    """ Returns MOHFW site data, or its diff. with covid19india.org data """
+    if dataSITE_raw is None:
+        return 'Data is unavailable. Please try later.'
+    dataSITE = dataSITE_raw.sort_values(by=['Active'], ascending=False)
+    data = _joinStatewise(dataSITE, dataMOHFW, '_MOHFW')
+    message = '\nMOHFW Reports (Site): ' \
+        + '\n\n' \
+        + 'ST' + '|'\
+        + 'ACTIV'.ljust(6, '.') + '|'\
+        + 'RCVRD'.ljust(6, '.') + '|'\
+        + 'DECSD'.ljust(6, '.') + '|'\
+        + 'CNFRD'.ljust(6, '.') + '\n'\
+        + '--|------|------|------|------\n'
+
+    cells = _formatCountColumns(data, _countColumns, '_MOHFW', compare)
+    stateCode = data['State_code'].astype(str).str.ljust(2, '.')
+    message = '```' + message + _joinColumns([stateCode] + cells) + '```'
+    return message
+
 
 def mohfwsite(update, context, compare=False):
     """ Compares covid19india.org data with MOHFW website data """
     logging.info('Command invoked: mohfwsite')
-    dataSITE_raw = _getSiteData()
-    dataSITE = _getSortedNational(dataSITE_raw, keyBasis='active')
-    try:
-        stateScraped, activeScraped, recoveredScraped, \
-                deathsScraped, confirmedScraped = _getMOHFWData(site=True)
-        message = '\nMOHFW Reports (Site): ' \
-            + '\n\n' \
-            + 'ST' + '|'\
-            + 'ACTIV'.ljust(6, '.') + '|'\
-            + 'RCVRD'.ljust(6, '.') + '|'\
-            + 'DECSD'.ljust(6, '.') + '|'\
-            + 'CNFRD'.ljust(6, '.') + '\n'\
-            + '--|------|------|------|------\n'
-        chars = 6
-
-        for state in dataSITE:
-            stateSITE = str(state[0])
-            activeSITE = state[1]
-            # Obtain deaths and recovered for each state from site dataset
-            for stateDict in dataSITE_raw['statewise']:
-                if stateSITE == stateDict['state']:
-                    activeSITE = int(stateDict['active'])
-                    deathsSITE = int(stateDict['deaths'])
-                    recoveredSITE = int(stateDict['recovered'])
-                    confirmedSITE = int(stateDict['confirmed'])
-
-            confirmedMOHFW = 'UNAVBL'
-            for i in range(len(stateScraped)):
-                stateMOHFW = _removeSpecialChars(stateScraped[i])
-                # Check for matching state name in MOHFW database
-                # 1. Handle Telangana misspelling
-                # 2. Handle '#' marks in some state names and cases
-                # 3. Handle "State Unassigned"
-                # 4. Handle "Dadar Nagar haveli"
-                if stateMOHFW == stateSITE or \
-                   (stateSITE == 'Telangana' and stateMOHFW == 'Telengana') or \
-                   (stateSITE == 'Dadra and Nagar Haveli and Daman and Diu' and \
-                    stateMOHFW == 'Dadar Nagar Haveli'):
-                    activeMOHFW = _removeSpecialChars(activeScraped[i])
-                    recoveredMOHFW = _removeSpecialChars(recoveredScraped[i])
-                    deathsMOHFW = _removeSpecialChars(deathsScraped[i])
-                    confirmedMOHFW = _removeSpecialChars(confirmedScraped[i])
-                    break
-                if stateSITE == 'State Unassigned' and \
-                   stateMOHFW == 'Cases being reassigned to states':
-                    confirmedMOHFW = _removeSpecialChars(confirmedScraped[i])
-                    activeMOHFW = _removeSpecialChars(activeScraped[i])
-                    deaths_diff = unavblCode
-                    recovered_diff = unavblCode
-                    break
-
-
-            stateCode = getStateCode(stateSITE)
-            if confirmedMOHFW == 'UNAVBL':
-                confirmedMOHFW = unavblCode
-                confirmed_diff = unavblCode
-                active_diff = unavblCode
-                recovered_diff = unavblCode
-                deaths_diff = unavblCode
-                activeMOHFW = unavblCode
-            else:
-                if compare == True:
-                    leadingPlus = '{0:+}'
-                    confirmed_diff = int(confirmedMOHFW) - confirmedSITE
-                    active_diff = int(activeMOHFW) - activeSITE
-                    if stateSITE != 'State Unassigned':
-                        # active_diff = int(confirmedMOHFW) - int(recoveredMOHFW) - \
-                        #     int(deathsMOHFW) - activeSITE
-                        recovered_diff = int(recoveredMOHFW) - recoveredSITE
-                        deaths_diff = int(deathsMOHFW) - deathsSITE
-                else:
-                    leadingPlus = '{0}'
-                    confirmed_diff = int(confirmedMOHFW)
-                    active_diff = int(activeMOHFW)
-                    if stateSITE != 'State Unassigned':
-                        # active_diff = int(confirmedMOHFW) - int(recoveredMOHFW) - \
-                        #     int(deathsMOHFW)
-                        recovered_diff = int(recoveredMOHFW)
-                        deaths_diff = int(deathsMOHFW)
-                # String formatting
-                confirmed_diff = leadingPlus.format(confirmed_diff).ljust(chars, ' ')
-                active_diff = leadingPlus.format(active_diff).ljust(chars, ' ')
-                if stateSITE != 'State Unassigned':
-                    recovered_diff = leadingPlus.format(recovered_diff).ljust(chars, ' ')
-                    deaths_diff = leadingPlus.format(deaths_diff).ljust(chars, ' ')
-                # Check for +0 and change to _0
-                if confirmed_diff.strip() == '+0':
-                    confirmed_diff = zeroCode
-                if active_diff.strip() == '+0':
-                    active_diff = zeroCode
-                if recovered_diff.strip() == '+0':
-                    recovered_diff = zeroCode
-                if deaths_diff.strip() == '+0':
-                    deaths_diff = zeroCode
-
-            message = message + \
-                stateCode.ljust(2, '.') + \
-                '|' + active_diff + '|' + recovered_diff + \
-                '|' + deaths_diff + '|' + confirmed_diff + '\n'
-
-        message = '```' + message + '```'
-
-    except TypeError:
-        message = 'Data is unavailable. Please try later.'
-
-    context.bot.send_message(chat_id=update.effective_chat.id, text=message,
-                             parse_mode=ParseMode.MARKDOWN,
-                             disable_web_page_preview=True)
+    message = _getCachedMessage(('mohfwsite', compare),
+                                ['national', 'mohfwsite'],
+                                lambda dataSITE, data: _getMessageMOHFWSite(
+                                    dataSITE, data, compare))
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message,
+                 parse_mode=ParseMode.MARKDOWN,
+                 disable_web_page_preview=True)
 
 def mohfw(update, context):
     """ Displays data from MOHFW """
@@ -626,6 +2248,14 @@ def comparemohfw(update, context):
     """ Displays difference in data between MOHFW and covid19india.org """
     """ Data retrieved using mohfwDefaultSource variable unless keyword is specified """
     logging.info('Command invoked: comparemohfw')
+    args = [arg.upper() for arg in context.args or []]
+    if 'CHART' in args:
+        source = 'mohfwsite' if 'SITE' in args else \
+            'mohfwapi' if 'API' in args else 'mohfw' + mohfwDefaultSource
+        _sendChart(context.bot, update.effective_chat.id,
+                   ('comparemohfw', source), ['national', source],
+                   _drawCompareMOHFW)
+        return
     if update.message.text.upper()  == '/COMPAREMOHFW API':
         logging.info('api keyword provided')
         mohfwapi(update, context, compare=True)
@@ -660,64 +2290,150 @@ def comparendma(update, context):
     else:
         ndmaapi(update, context, compare=True)
 
-def recon(update, context):
-    """ Checks for some invalid values in data """
-    logging.info('Command invoked: recon')
+def _formatReconRows(districts, chars):
+    """ Returns two line table rows of the counts of districts """
+    rows = districts['State_Code'].astype(str) + '|' + \
+        districts['District'].astype(str).str[0:chars].str.ljust(chars, '.')
+    for column in ['Confirmed', 'Active']:
+        rows = rows + '|' + districts[column].astype(str).str.ljust(chars, ' ')
+    rows = rows + '|\n__________'
+    for column in ['Recovered', 'Deceased']:
+        rows = rows + '|' + districts[column].astype(str).str.ljust(chars, ' ')
+    return ''.join(rows + '|\n')
+
+
+def _getMessageRecon(data):
+    """ Returns districts with invalid values in data """
+    if data is None:
+        return 'Data is unavailable. Please try later.'
     chars = 7
-    data = _getSiteData(statewise=True)
     messageHeader = ' Districts with invalid values\n' + \
             '______________________________\n\n' + \
             'ST|DSTRICT|CNFRD..|ACTIV..|\n' + \
             '__________|RCVRD..|DECSD..|\n' + \
             '--|-------|-------|-------|\n'
-    message = ''
-    messageUn = ''
-
-    for stateDict in data:
-        stateCode = stateDict['statecode']
-        for districtDict in stateDict['districtData']:
-            districtName = districtDict['district']
-            active = districtDict['active']
-            confirmed = districtDict['confirmed']
-            recovered = districtDict['recovered']
-            deceased = districtDict['deceased']
-
-            if districtName == 'Unknown':
-                if (confirmed != 0) or (recovered != 0) or (deceased != 0):
-                    messageUn += stateCode + '|' + \
-                            districtName[0:chars].ljust(chars, '.') + '|' + \
-                            str(confirmed).ljust(chars, ' ') + '|' + \
-                            str(active).ljust(chars, ' ') + '|\n__________|' + \
-                            str(recovered).ljust(chars, ' ') + '|' + \
-                            str(deceased).ljust(chars, ' ') + '|\n'
-            else:
-                if (confirmed < 0) or (active < 0) or \
-                   (recovered < 0) or (deceased < 0):
-                    message += stateCode + '|' + \
-                            districtName[0:chars].ljust(chars, '.') + '|' + \
-                            str(confirmed).ljust(chars, ' ') + '|' + \
-                            str(active).ljust(chars, ' ') + '|\n__________|' + \
-                            str(recovered).ljust(chars, ' ') + '|' + \
-                            str(deceased).ljust(chars, ' ') + '|\n'
+    index = _getDistrictIndex(data)
+    messageUn = _formatReconRows(index['unknown'], chars)
+    message = _formatReconRows(index['invalid'], chars)
 
     messageUn += '--|-------|-------|-------|\n'
     message = '```' + messageHeader + messageUn + message + '```'
-    context.bot.send_message(chat_id=update.effective_chat.id, text=message,
-                             parse_mode=ParseMode.MARKDOWN,
-                             disable_web_page_preview=True)
+    return message
+
+
+def recon(update, context):
+    """ Checks for some invalid values in data """
+    logging.info('Command invoked: recon')
+    message = _getCachedMessage(('recon',), ['district'], _getMessageRecon)
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message,
+                 parse_mode=ParseMode.MARKDOWN,
+                 disable_web_page_preview=True)
+
+def _getMessageStats():
+    """ Returns latencies per phase and cache hit rates """
+    with _metricsLock:
+        histograms = {key: (list(value[0]), value[1], value[2])
+                      for key, value in _histograms.items()
+                      if key[0].endswith('_seconds')}
+        counters = dict(_counters)
+    message = 'PHASE/LABEL.........|COUNT.|MEAN ms|P95 ms\n' + \
+              '--------------------|------|-------|------\n'
+    buckets = _histogramBuckets['seconds']
+    for (name, label), (counts, count, total) in sorted(histograms.items()):
+        # Upper bound of the bucket holding the 95th percentile
+        p95 = next((str(int(bound * 1000)) for bound, bucketCount
+                    in zip(buckets, counts) if bucketCount >= 0.95 * count),
+                   '>' + str(int(buckets[-1] * 1000)))
+        message += (name[:-len('_seconds')] + '/' + label)[:20].ljust(20) + \
+            '|' + str(count).ljust(6) + '|' + \
+            str(int(total / count * 1000)).ljust(7) + '|' + p95 + '\n'
+
+    message += '\nCACHE/LABEL.........|HITS..|MISSES|HIT %\n' + \
+               '--------------------|------|------|-----\n'
+    for cache in ['snapshot', 'message_cache']:
+        labels = sorted(set(label for name, label in counters
+                            if name in [cache + '_hits', cache + '_misses']))
+        for label in labels:
+            hits = counters.get((cache + '_hits', label), 0)
+            misses = counters.get((cache + '_misses', label), 0)
+            message += (cache.split('_')[0] + '/' + label)[:20].ljust(20) + \
+                '|' + str(hits).ljust(6) + '|' + str(misses).ljust(6) + \
+                '|' + str(int(100 * hits / (hits + misses))) + '\n'
+    return '```\n' + message + '```'
+
+
+def stats(update, context):
+    """ Displays latencies and cache hit rates to admins """
+    """ isAdmin lets anyone in a private chat through, so only the users
+    listed in statsAdminIds get the stats """
+    logging.info('Command invoked: stats')
+    if update.message.from_user.id not in statsAdminIds:
+        return
+    _sendMessage(context.bot, chat_id=update.effective_chat.id,
+                 text=_getMessageStats(),
+                 parse_mode=ParseMode.MARKDOWN)
+
+
+def subscribe(update, context):
+    """ Subscribes a chat to alerts about a state or source """
+    logging.info('Command invoked: subscribe')
+    topic = _getSubscriptionTopic(context.args)
+    if topic is None:
+        message = 'Use /subscribe <mohfw/ndma/state> to receive alerts.'
+    else:
+        _subscribe(update.effective_chat.id, topic)
+        message = 'Subscribed to alerts for ' + topic.upper()
+
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message)
+
+def unsubscribe(update, context):
+    """ Unsubscribes a chat from alerts about a state or source """
+    logging.info('Command invoked: unsubscribe')
+    topic = _getSubscriptionTopic(context.args)
+    if topic is None:
+        message = 'Use /unsubscribe <mohfw/ndma/state> to stop alerts.'
+    else:
+        _subscribe(update.effective_chat.id, topic, enable=False)
+        message = 'Unsubscribed from alerts for ' + topic.upper()
+
+    _sendMessage(context.bot, chat_id=update.effective_chat.id, text=message)
+
+def _getChatMemberStatus(bot, chatId, userId):
+    """ Returns the status of a user in a chat, cached for adminCacheTTL """
+    key = (chatId, userId)
+    with _chatMemberCacheLock:
+        cached = _chatMemberCache.get(key)
+    if cached is not None and time.time() < cached[1]:
+        return cached[0]
+
+    status = bot.get_chat_member(chat_id=chatId, user_id=userId)['status']
+    with _chatMemberCacheLock:
+        if len(_chatMemberCache) > 10000:
+            _chatMemberCache.clear()
+        _chatMemberCache[key] = (status, time.time() + adminCacheTTL)
+    return status
+
+
+def chatMembersChanged(update, context):
+    """ Forgets the cached status of users who joined or left a chat """
+    users = list(update.message.new_chat_members or [])
+    if update.message.left_chat_member is not None:
+        users.append(update.message.left_chat_member)
+    with _chatMemberCacheLock:
+        for user in users:
+            _chatMemberCache.pop((update.effective_chat.id, user.id), None)
+
 
 def isAdmin(update, context):
     """ Check if user is admin """
-    status = context.bot.get_chat_member( \
-                                         chat_id=update.effective_chat.id, \
-                                         user_id=update.message.from_user.id)['status']
-    chatType = context.bot.get_chat( \
-                                    chat_id=update.effective_chat.id \
-                                    )['type']
+    status = _getChatMemberStatus(context.bot, update.effective_chat.id,
+                                  update.message.from_user.id)
+    # The chat type is part of the update, no need to ask Telegram for it
+    chatType = update.effective_chat.type
 
     logging.info('Command invoked by ' + status + ' from ' + chatType + ' chat')
-    if status.encode('ascii', 'ignore') == 'member':
-        if chatType.encode('ascii', 'ignore') == 'private':
+    if status == 'member':
+        if chatType == 'private':
             return True
         return False
     else:
@@ -745,38 +2461,77 @@ def request(update, context):
         if _allowRequests:
             # Forward to requests channel
             if update.message.reply_to_message.text:
-                context.bot.forward_message(chat_id='@covid19indiaorg_resource_req', \
-                                            from_chat_id=update.effective_chat.id, \
-                                            message_id=update.message.reply_to_message.message_id, \
-                                            parse_mode=ParseMode.MARKDOWN, \
-                                            disable_web_page_preview=True)
+                _forwardMessage(context.bot, chat_id='@covid19indiaorg_resource_req', \
+                                from_chat_id=update.effective_chat.id, \
+                                message_id=update.message.reply_to_message.message_id, \
+                                parse_mode=ParseMode.MARKDOWN, \
+                                disable_web_page_preview=True)
             else:
-                context.bot.forward_message(chat_id='@covid19indiaorg_resource_req', \
-                                            from_chat_id=update.effective_chat.id, \
-                                            message_id=update.message.message_id, \
-                                            parse_mode=ParseMode.MARKDOWN, \
-                                            disable_web_page_preview=True)
+                _forwardMessage(context.bot, chat_id='@covid19indiaorg_resource_req', \
+                                from_chat_id=update.effective_chat.id, \
+                                message_id=update.message.message_id, \
+                                parse_mode=ParseMode.MARKDOWN, \
+                                disable_web_page_preview=True)
 
             # Reply to sender with acknowledgement
             if _allowRequestsReply:
-                context.bot.send_message(chat_id=update.effective_chat.id, \
-                                         text=message, \
-                                         parse_mode=ParseMode.MARKDOWN, \
-                                         disable_web_page_preview=True, \
-                                         disable_notification=True, \
-                                         reply_to_message_id=update.message.message_id
-                                        )
+                _sendMessage(context.bot, chat_id=update.effective_chat.id, \
+                             text=message, \
+                             parse_mode=ParseMode.MARKDOWN, \
+                             disable_web_page_preview=True, \
+                             disable_notification=True, \
+                             reply_to_message_id=update.message.message_id
+                            )
 
         if isAdmin(update, context):
             if update.message.text.upper() == '/REQUEST DISABLE':
                 _allowRequests = False
 
 
+# Renderers of messages that can be built in render processes, called with
+# the data of the sources followed by the rest of the message name
+_sharedRenderers = {'national': _getMessageNational,
+                    'statewise': _getMessageStatewise,
+                    'mohfwapi': _getMessageMOHFWAPI,
+                    'ndmaapi': _getMessageNDMAAPI,
+                    'mohfwsite': _getMessageMOHFWSite,
+                    'recon': _getMessageRecon}
+
+
+def _warmUp():
+    """ Imports the modules that were left to first use """
+    pd.DataFrame
+    requests.Session
+    logging.info('Warm up: DONE')
+
+
+def _nonBlocking(callback):
+    """ Runs the handler in the dispatcher worker pool when asyncHandlers is
+    set, so that the next update is processed without waiting for it """
+    if not asyncHandlers:
+        return callback
+
+    @functools.wraps(callback)
+    def runAsync(update, context):
+        context.dispatcher.run_async(callback, update, context)
+    return runAsync
+
+
 def main():
+    _startLogging()
     logging.info('covid19india_bot started')
 
+    global _alertBot
     _initStateCodes('statecodes.json')
-    updater = Updater(token=_readToken(_tokenFile), use_context=True)
+    _startRenderProcesses('statecodes.json')
+    _loadSubscriptions()
+    _loadAlertedDrift()
+    _loadChartFileIds()
+    token = _readToken(_tokenFile)
+    updater = Updater(token=token, use_context=True, workers=updateWorkers)
+    _alertBot = updater.bot
+    _startPrefetch(updater.job_queue)
+    _startMetricsServer()
 
     updater.dispatcher.add_handler(CommandHandler('start', start))
     updater.dispatcher.add_handler(CommandHandler('help', help))
@@ -790,19 +2545,37 @@ def main():
     updater.dispatcher.add_handler(CommandHandler('comparendma', comparendma))
 
     updater.dispatcher.add_handler(CommandHandler('recon', recon))
+    updater.dispatcher.add_handler(CommandHandler('stats', stats))
+
+    updater.dispatcher.add_handler(CommandHandler('subscribe', subscribe))
+    updater.dispatcher.add_handler(CommandHandler('unsubscribe', unsubscribe))
 
     updater.dispatcher.add_handler(CommandHandler('advanced', advanced))
 
     updater.dispatcher.add_handler(CommandHandler('request', request))
+    updater.dispatcher.add_handler(InlineQueryHandler(inlineQuery))
+    updater.dispatcher.add_handler(MessageHandler(
+        Filters.status_update.new_chat_members |
+        Filters.status_update.left_chat_member, chatMembersChanged))
     updater.dispatcher.add_handler(MessageHandler(Filters.regex('#request') | \
                                                   Filters.regex('#resources'), \
                                                   request))
-
-
-    updater.start_polling()
+    for handler in updater.dispatcher.handlers[0]:
+        handler.callback = _nonBlocking(_instrumented(handler.callback))
+
+    if webhookURL:
+        # Telegram posts to a path only the bot knows
+        updater.start_webhook(listen=webhookListen, port=webhookPort,
+                              url_path=token,
+                              webhook_url=webhookURL.rstrip('/') + '/' + token)
+    else:
+        updater.start_polling()
+    # Polling has started, the first command no longer pays for the imports
+    threading.Timer(warmUpDelay, _warmUp).start()
     updater.idle()
 
 
 if __name__ == '__main__':
     main()
     logging.info('Program end')
+    _stopLogging()